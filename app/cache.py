@@ -0,0 +1,67 @@
+# in-process cache of serialized responses
+from collections import OrderedDict
+import threading
+
+# LRU cache of response bodies (bytes), bounded by total size in bytes
+# entries belong to a single data version: the first lookup or insert with the version
+# of the currently published data (given by current) empties the cache, so stale responses
+# are never served; lookups and inserts with other versions, e.g., from requests still
+# holding an older snapshot, are ignored
+class ResponseCache:
+
+    def __init__(self, max_bytes, current):
+        self.max_bytes = max_bytes
+        self.current = current
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.version = None
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    # switch cache to a new data version if it is the current version (call with lock held)
+    # (returns whether the cache holds entries of the version)
+    def _set_version(self, version):
+        if version != self.version:
+            if version != self.current():
+                return False
+            self.entries.clear()
+            self.size = 0
+            self.version = version
+        return True
+
+    # get response body for key (None if not cached)
+    def get(self, version, key):
+        with self.lock:
+            body = self.entries.get(key) if self._set_version(version) else None
+            if body is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return body
+
+    # add response body for key
+    # (ignored if data have changed since the response was built or body is too large)
+    def put(self, version, key, body):
+        with self.lock:
+            if not self._set_version(version) or len(body) > self.max_bytes:
+                return
+            if key in self.entries:
+                self.size -= len(self.entries.pop(key))
+            self.entries[key] = body
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                self.size -= len(self.entries.popitem(last = False)[1])
+
+    # cache statistics
+    def info(self):
+        with self.lock:
+            return {
+                "version": self.version,
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses
+            }
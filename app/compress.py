@@ -0,0 +1,121 @@
+# response compression (gzip, brotli)
+import zlib
+import brotli
+from starlette.datastructures import Headers, MutableHeaders
+
+# encodings in order of preference
+encodings = ["br", "gzip"]
+
+# responses smaller than this (in bytes) are not compressed
+minimum_size = 500
+
+# content types that are not compressed (already compressed)
+excluded_types = ["application/vnd.apache.parquet"]
+
+# function: choose content encoding from Accept-Encoding header (None for no encoding)
+def accept_encoding(header):
+    accepted = {}
+    for item in header.split(","):
+        parts = item.strip().split(";")
+        q = 1.0
+        for p in parts[1:]:
+            p = p.strip()
+            if p.startswith("q="):
+                try:
+                    q = float(p[2:])
+                except ValueError:
+                    q = 0.0
+        accepted[parts[0].strip().lower()] = q
+    for enc in encodings:
+        if accepted.get(enc, accepted.get("*", 0.0)) > 0:
+            return enc
+    return None
+
+# function: create compressor for encoding
+# (returns functions to compress a chunk and to finish the stream)
+def compressor(encoding, level):
+    if encoding == "br":
+        c = brotli.Compressor(quality = level)
+        return c.process, c.finish
+    elif encoding == "gzip":
+        c = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return c.compress, c.flush
+    else:
+        raise ValueError("Invalid encoding: " + str(encoding))
+
+# function: compress complete body
+def compress(body, encoding, level):
+    process, finish = compressor(encoding, level)
+    return process(body) + finish()
+
+# compress responses (including streamed responses) with the encoding accepted by the client
+# responses that already have a Content-Encoding (e.g., precompressed cached bodies) are
+# passed through; strong ETags of encoded responses are made weak, since they are shared
+# with the unencoded response
+class CompressionMiddleware:
+
+    def __init__(self, app, gzip_level = 6, brotli_quality = 4):
+        self.app = app
+        self.levels = {"gzip": gzip_level, "br": brotli_quality}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = accept_encoding(Headers(scope = scope).get("accept-encoding", ""))
+        start = None
+        stream = None
+
+        async def send_encoded(message):
+            nonlocal start, stream
+            if message["type"] == "http.response.start":
+                # hold headers until the first body chunk is seen
+                start = message
+                return
+            if message["type"] != "http.response.body":
+                await send(message)
+                return
+            if start is not None:
+                body = message.get("body", b"")
+                more_body = message.get("more_body", False)
+                headers = MutableHeaders(raw = start["headers"])
+                media_type = headers.get("content-type", "").split(";")[0].strip()
+                if media_type not in excluded_types and "accept-encoding" not in headers.get("vary", "").lower():
+                    headers.add_vary_header("Accept-Encoding")
+                # size of response (unknown for streamed responses without Content-Length)
+                if "content-length" in headers:
+                    size = int(headers["content-length"])
+                elif not more_body:
+                    size = len(body)
+                else:
+                    size = None
+                if "content-encoding" in headers:
+                    weaken_etag(headers)
+                elif (encoding is not None and start["status"] == 200 and media_type not in excluded_types
+                    and (size is None or size >= minimum_size)):
+                    stream = compressor(encoding, self.levels[encoding])
+                    body = stream[0](body)
+                    if not more_body:
+                        body += stream[1]()
+                        headers["Content-Length"] = str(len(body))
+                    elif "content-length" in headers:
+                        del headers["Content-Length"]
+                    headers["Content-Encoding"] = encoding
+                    weaken_etag(headers)
+                    message = {"type": "http.response.body", "body": body, "more_body": more_body}
+                await send(start)
+                start = None
+            elif stream is not None:
+                body = stream[0](message.get("body", b""))
+                if not message.get("more_body", False):
+                    body += stream[1]()
+                message = {"type": "http.response.body", "body": body, "more_body": message.get("more_body", False)}
+            await send(message)
+
+        await self.app(scope, receive, send_encoded)
+
+# function: make strong ETag weak
+def weaken_etag(headers):
+    etag = headers.get("etag")
+    if etag is not None and not etag.startswith("W/"):
+        headers["ETag"] = "W/" + etag
@@ -0,0 +1,54 @@
+# HTTP conditional requests (ETag / Last-Modified / 304 Not Modified)
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+import hashlib
+import re
+import pytz
+
+# function: parse version string (e.g., "2023-01-15 12:00 EST" or an HTTP date) as datetime
+# (returns None if the version cannot be parsed)
+def version_datetime(v):
+    if isinstance(v, bytes):
+        v = v.decode()
+    v = str(v).strip()
+    try:
+        m = re.match(r"^\d{4}-\d{2}-\d{2} \d{2}:\d{2}", v)
+        if m:
+            return pytz.timezone("America/Toronto").localize(datetime.strptime(m.group(0), "%Y-%m-%d %H:%M"))
+        return parsedate_to_datetime(v)
+    except (TypeError, ValueError):
+        return None
+
+# function: ETag for a route from data versions and normalized query parameters
+# (parameters are sorted by name; the order of repeated parameters is kept, since it
+# can change the response)
+def make_etag(route, versions, query_params):
+    query = sorted(query_params.multi_items(), key = lambda x: x[0])
+    tag = repr((route, [v.decode() if isinstance(v, bytes) else str(v) for v in versions], query))
+    return '"' + hashlib.sha1(tag.encode("utf-8")).hexdigest() + '"'
+
+# function: format datetime as HTTP date
+def http_date(v):
+    return format_datetime(v.astimezone(timezone.utc), usegmt = True)
+
+# function: check whether the client's cached copy is still valid
+# (returns the ETag to send with the 304 response, in the weak or strong form of the
+# client's matching tag, or None if the copy is not valid; If-Modified-Since is only
+# used when If-None-Match is absent)
+def not_modified(headers, etag, last_modified):
+    if_none_match = headers.get("if-none-match")
+    if if_none_match is not None:
+        for tag in [x.strip() for x in if_none_match.split(",")]:
+            if tag == "*":
+                return etag
+            if tag == etag or tag == "W/" + etag:
+                return tag
+        return None
+    if_modified_since = headers.get("if-modified-since")
+    if if_modified_since is not None and last_modified is not None:
+        since = version_datetime(if_modified_since)
+        if since is None or since.tzinfo is None:
+            return None
+        if last_modified.replace(second = 0, microsecond = 0) <= since:
+            return etag
+    return None
@@ -0,0 +1,118 @@
+# archive file index stored in SQLite
+# the database is built once per version of index.db, with the derived columns (dataset
+# directories, file URL, final file for date) materialized, the rows of each dataset stored
+# together and the first and last file of each dataset precomputed, so a query only reads
+# the rows it returns
+import os
+import sqlite3
+import urllib.parse
+import pandas as pd
+
+# columns of the file index, in output order
+columns = [
+    "uuid", "dir_parent", "dir_file", "file_name", "file_timestamp", "file_date", "file_duplicate",
+    "file_final_for_date", "file_md5", "file_size", "file_url"]
+
+# function: build file index database at path from index.db (at src) and datasets.json
+# (rows keep the order of index.db in the id column; columns have no declared types,
+# so values are stored as they are in index.db; files without a UUID are left out,
+# since no query can select them)
+def build(src, datasets, path):
+    if os.path.exists(path + ".part"):
+        os.remove(path + ".part")
+    con = sqlite3.connect(path + ".part")
+    try:
+        con.execute("PRAGMA journal_mode = OFF")
+        con.execute("PRAGMA synchronous = OFF")
+        con.execute("ATTACH DATABASE ? AS src", (src,))
+        ## extract uuid, dir_parent, dir_file from datasets.json for each dataset
+        con.execute("CREATE TEMP TABLE datasets (uuid, dir_parent, dir_file)")
+        con.executemany("INSERT INTO datasets VALUES (?, ?, ?)",
+            [(d.get("uuid"), d.get("dir_parent"), d.get("dir_file")) for d in datasets.values()])
+        ## merge dataset metadata with archive index, calculate the file URL of each
+        ## non-duplicate file (duplicates get the URL of the matching non-duplicate file)
+        ## and whether each file is the final unique file for a given UUID and date
+        ## (rows are stored clustered by UUID, in index order within each UUID)
+        con.execute("CREATE TEMP TABLE merged (" + ", ".join(columns) + ")")
+        con.execute("""
+            INSERT INTO merged
+            SELECT a.uuid, d.dir_parent, d.dir_file, a.file_name, a.file_timestamp, a.file_date, a.file_duplicate,
+                COALESCE(a.file_timestamp = MAX(a.file_timestamp) OVER (PARTITION BY a.uuid, a.file_date), 0),
+                a.file_md5, a.file_size,
+                'https://data.opencovid.ca/archive/' || u.dir_parent || '/' || u.dir_file || '/' || u.file_name
+            FROM src.archive a
+            LEFT JOIN datasets d ON d.uuid = a.uuid
+            LEFT JOIN (
+                SELECT b.rowid AS row, b.uuid, b.file_md5, b.file_size, b.file_name, e.dir_parent, e.dir_file
+                FROM src.archive b LEFT JOIN datasets e ON e.uuid = b.uuid
+                WHERE b.file_duplicate = 0
+            ) u ON u.uuid = a.uuid AND u.file_md5 = a.file_md5 AND u.file_size = a.file_size
+            WHERE a.uuid IS NOT NULL
+            ORDER BY a.rowid, u.row""")
+        con.execute("CREATE TABLE archive (id INTEGER, " + ", ".join(columns) + ", PRIMARY KEY (uuid, id)) WITHOUT ROWID")
+        con.execute("INSERT INTO archive SELECT rowid, * FROM merged ORDER BY uuid, rowid")
+        con.execute("DROP TABLE merged")
+        ## index rows of each dataset by date and by final file for date
+        con.execute("CREATE INDEX archive_date ON archive (uuid, file_date)")
+        con.execute("CREATE INDEX archive_final ON archive (uuid, file_final_for_date, file_date)")
+        ## precompute first and last file of each dataset (like groupby("uuid").first() / .last():
+        ## each column takes its first / last non-missing value) and its number of files
+        cols = columns[1:]
+        con.execute("CREATE TABLE ends (uuid, last, files, " + ", ".join(cols) + ", PRIMARY KEY (uuid, last)) WITHOUT ROWID")
+        for last, order in [(0, "ASC"), (1, "DESC")]:
+            con.execute(
+                "INSERT INTO ends SELECT uuid, " + str(last) + ", n, " + ", ".join(
+                    "(SELECT " + col + " FROM archive a WHERE a.uuid = u.uuid AND " + col + " IS NOT NULL ORDER BY id " + order + " LIMIT 1)"
+                    for col in cols) + " FROM (SELECT uuid, COUNT(*) AS n FROM archive GROUP BY uuid) u")
+        con.execute("ANALYZE")
+        con.commit()
+        con.execute("DETACH DATABASE src")
+    finally:
+        con.close()
+    os.replace(path + ".part", path)
+
+# function: open file index database (read-only; the file never changes once built)
+def connect(path):
+    return sqlite3.connect(
+        "file:" + urllib.parse.quote(path) + "?mode=ro&immutable=1", uri = True, check_same_thread = False)
+
+# function: placeholders for a list of query parameters
+def placeholders(values):
+    return "(" + ", ".join(["?"] * len(values)) + ")"
+
+# function: number of files of each dataset in the file index (by UUID, sorted)
+def file_counts(con, uuid):
+    res = con.execute(
+        "SELECT uuid, files FROM ends WHERE uuid IN " + placeholders(uuid) + " AND last = 1 ORDER BY uuid", uuid)
+    return dict(res.fetchall())
+
+# function: conditions and parameters selecting files of datasets
+# (date filters are compared with file_date as "YYYY-MM-DD" strings)
+def conditions(uuid, date = None, after = None, before = None, final = False):
+    where = ["uuid IN " + placeholders(uuid)]
+    params = list(uuid)
+    for op, value in [("=", date), (">=", after), ("<=", before)]:
+        if value is not None:
+            where.append("file_date " + op + " ?")
+            params.append(value)
+    if final:
+        where.append("file_final_for_date = 1")
+    return " AND ".join(where), params
+
+# function: files of datasets, in index order
+def files(con, uuid, date = None, after = None, before = None, final = False):
+    where, params = conditions(uuid, date, after, before, final)
+    return pd.read_sql(
+        "SELECT " + ", ".join(columns) + " FROM archive WHERE " + where + " ORDER BY id", con, params = params)
+
+# function: whether any files of datasets match
+def any_files(con, uuid, date = None, after = None, before = None):
+    where, params = conditions(uuid, date, after, before)
+    return con.execute("SELECT EXISTS (SELECT 1 FROM archive WHERE " + where + ")", params).fetchone()[0] == 1
+
+# function: first or last file of each dataset (rows are sorted by UUID and have no uuid column)
+def ends(con, uuid, last = True):
+    rows = con.execute(
+        "SELECT " + ", ".join(columns[1:]) + " FROM ends WHERE uuid IN " + placeholders(uuid) + " AND last = ? ORDER BY uuid",
+        list(uuid) + [int(last)]).fetchall()
+    return pd.DataFrame.from_records(rows, columns = columns[1:])
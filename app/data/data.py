@@ -1,20 +1,64 @@
 # load libraries
-from apscheduler.schedulers.background import BackgroundScheduler
+import asyncio
 import os
+import shutil
+import numpy as np
 import pandas as pd
-from datetime import datetime
+from datetime import date, datetime
 from pytz import utc, timezone
 import json
-import requests
+import hashlib
 import tempfile
+import threading
+import time
 import sqlite3
 import git
+from app.data import archive_index, fetch, shared
 
-# define no cache headers
-no_cache_headers = {
-    "Cache-Control": "no-cache",
-    "Pragma": "no-cache"
-}
+# upstream data
+url_ctc = "https://github.com/ccodwg/CovidTimelineCanada.git"
+url_datasets = "https://raw.githubusercontent.com/ccodwg/Covid19CanadaArchive/master/datasets.json"
+url_version_datasets = "https://api.github.com/repos/ccodwg/Covid19CanadaArchive/commits?path=datasets.json"
+url_archive_index = "https://data.opencovid.ca/archive/index.db"
+url_version_archive_index = "https://data.opencovid.ca/archive/update_time.txt"
+
+# data (loaded in the background when the app starts, see start_data)
+snapshot = None
+datasets = {}
+version_datasets = None
+archive = {} # file index database (path and connection)
+version_archive_index = None
+temp_dir = None
+archive_builds = 0 # number of file index databases built
+
+# background loading and updates (see start_data)
+client = None # pooled HTTP client
+tasks = [] # tasks loading data at startup
+refresh_task = None # task checking for updates
+refresh_interval = int(os.environ.get("API_REFRESH_INTERVAL", 300)) # seconds between checks for updates
+refreshing = False # whether a check for updates is running
+
+# status of each dataset: "loading", "ready" or "failed" (failed loads are retried)
+# routes return 503 until the datasets they use are ready
+status = {"ctc": "loading", "datasets": "loading", "archive": "loading"}
+errors = {} # last error of datasets whose last load or update attempt failed
+retry_delay = 30 # seconds between attempts to load a dataset
+git_timeout = 600 # seconds before a git clone or pull is killed
+
+# directory for sharing data between processes, e.g., gunicorn workers (not shared if unset)
+# the first process to start becomes the loader, which downloads, builds and publishes the
+# data; the other processes map the latest published data and switch when it changes
+shared_dir = os.environ.get("API_SHARED_DIR")
+loader = True # whether this process loads the data (set at startup)
+counter = None # mapped generation counter (shared directory only)
+generation = 0 # generation of shared data in use (processes other than the loader)
+sync_lock = threading.Lock()
+publish_lock = threading.Lock()
+
+# directory for the on-disk snapshot cache (not cached if unset)
+# the loader saves every new version of the data there, in the same format as the shared
+# directory, and starts from the saved data while it checks the sources in the background
+cache_dir = os.environ.get("API_CACHE_DIR")
 
 # function: convert timestamp
 def convert_timestamp(v):
@@ -24,11 +68,256 @@ def convert_timestamp(v):
     v = v.strftime("%Y-%m-%d %H:%M %Z")
     return v
 
+# function: hash file contents (used to detect files that changed between reloads)
+def file_hash(path):
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+# function: convert date to int32 day ordinal (days since 1970-01-01)
+def day_ordinal(v):
+    return np.int32((v - date(1970, 1, 1)).days)
+
+# function: combine group numbers and day ordinals into sortable search keys
+def date_key(group, d):
+    return (np.asarray(group, dtype = np.int64) << 32) + np.asarray(d, dtype = np.int64)
+
+# function: convert categories to names with a lookup (missing names are unknown, if given)
+def category_names(cats, lookup, unknown = None):
+    names = pd.Series(cats, dtype = object).map(lookup)
+    if unknown is not None:
+        names = names.fillna(unknown)
+    return names.to_numpy(dtype = object)
+
+# function: rank categories by their converted names (missing names sort last)
+def rank_categories(cats, lookup, unknown = None):
+    names = pd.Series(category_names(cats, lookup, unknown), dtype = object)
+    return names.rank(method = "dense", na_option = "bottom").to_numpy().astype(np.int32)
+
+# function: names of the geographic categories of a store under each naming scheme
+# (region: short, canonical, pruid, ccodwg; sub_region_1: hruid, canonical, short, ccodwg;
+# a name array holds the name of each category code, so renaming a column is a single take)
+def geo_names(s, ctc):
+    names = {}
+    cats = s["region_cats"]
+    if s["geo"] == "can":
+        names["region"] = {k: np.full(len(cats), v, dtype = object) for k, v in
+            [("short", "CAN"), ("canonical", "Canada"), ("pruid", 1), ("ccodwg", "Canada")]}
+        return names
+    pt = ctc["pt"].set_index("region")
+    names["region"] = {"short": cats}
+    for k, col in [("canonical", "name_canonical"), ("pruid", "pruid"), ("ccodwg", "name_ccodwg")]:
+        names["region"][k] = category_names(cats, pt[col])
+    if s["geo"] == "hr":
+        hr = ctc["hr"].set_index("hruid")
+        cats = s["sub_region_1_cats"]
+        names["sub_region_1"] = {"hruid": cats}
+        for k, col, unknown in [
+            ("canonical", "name_canonical", "Unknown"),
+            ("short", "name_short", "Unknown"),
+            ("ccodwg", "name_ccodwg", "Not Reported")]:
+            names["sub_region_1"][k] = category_names(cats, hr[col], unknown)
+    return names
+
+# function: check whether a column holds text (object, string or categorical columns)
+# (pandas 3 reads and builds text columns as strings rather than objects)
+def is_text(x):
+    return pd.api.types.is_object_dtype(x) or pd.api.types.is_string_dtype(x) or isinstance(x.dtype, pd.CategoricalDtype)
+
+# function: build read-optimized store for a CovidTimelineCanada table
+# (ctc holds the pt and hr name tables used for the legacy row order)
+# row arrays are all numeric, so stores can be shared between processes without copies
+def build_store(d, geo, ctc, orders = ["order", "order_legacy"]):
+    # geographic columns, in sort order
+    geo_cols = ["region", "sub_region_1"] if geo == "hr" else ["region"]
+    s = {"geo": geo, "cols": list(d.columns), "geo_cols": geo_cols, "cat_cols": []}
+    # store dates as int32 day ordinals (tables read by read_table already hold them)
+    if d["date"].dtype == np.int32:
+        s["date"] = d["date"].to_numpy()
+    else:
+        s["date"] = d["date"].values.astype("datetime64[D]").astype(np.int32)
+    for col in s["cols"]:
+        if col in geo_cols or (col != "date" and is_text(d[col])):
+            # store region, sub_region_1 and other text columns as categorical codes
+            # (geographic categories are sorted, which gives the row order of the store)
+            if col in geo_cols:
+                cat = pd.Categorical(np.asarray(d[col], dtype = object))
+                codes, cats = cat.codes, cat.categories
+            else:
+                codes, cats = pd.factorize(d[col], use_na_sentinel = False)
+                codes = codes.astype(np.int32)
+            s[col] = codes
+            s[col + "_cats"] = np.asarray(cats, dtype = object)
+            s["cat_cols"].append(col)
+        elif col != "date":
+            s[col] = d[col].to_numpy()
+    # sort rows by geographic group and date
+    o = np.lexsort([s["date"]] + [s[col] for col in reversed(geo_cols)])
+    for col in s["cols"]:
+        s[col] = s[col][o]
+    # index geographic groups (region, sub_region_1) to contiguous row ranges
+    new_group = np.ones(len(o), dtype = bool)
+    if len(o) > 0:
+        new_group[1:] = np.any([s[col][1:] != s[col][:-1] for col in geo_cols], axis = 0)
+    s["group_start"] = np.flatnonzero(new_group)
+    s["group_end"] = np.append(s["group_start"][1:], len(o))
+    # group/date search key (dates are sorted within each group)
+    group = np.cumsum(new_group) - 1
+    s["date_key"] = date_key(group, s["date"])
+    # row orders for responses (stored with the position of each row within them):
+    # order: timeseries order with short names/hruid (None if same as row order)
+    # order_legacy: legacy timeseries order (ccodwg names)
+    # order_summary: summary order (date first) with short names/hruid
+    s["orders"] = list(orders)
+    for col in orders:
+        if col == "order":
+            o = np.lexsort((s["sub_region_1"], s["date"], s["region"])) if geo == "hr" else None
+        elif col == "order_legacy":
+            pt_rank = rank_categories(s["region_cats"], ctc["pt"].set_index("region")["name_ccodwg"])
+            if geo == "hr":
+                hr_rank = rank_categories(
+                    s["sub_region_1_cats"], ctc["hr"].set_index("hruid")["name_ccodwg"], "Not Reported")
+                o = np.lexsort((s["date"], hr_rank[s["sub_region_1"]], pt_rank[s["region"]]))
+            else:
+                o = np.lexsort((s["date"], pt_rank[s["region"]]))
+        elif col == "order_summary":
+            o = np.lexsort([s[x] for x in reversed(geo_cols)] + [s["date"]])
+        s[col] = o
+        if o is None:
+            s[col + "_pos"] = None
+        else:
+            s[col + "_pos"] = np.empty(len(s["date"]), dtype = np.int64)
+            s[col + "_pos"][o] = np.arange(len(s["date"]))
+    return index_store(s, ctc)
+
+# function: build long-format store holding the rows of several stores of a geo level
+# (e.g., one per stat; the rows and groups of each store follow each other in the given
+# order, categories are merged and value columns that are floats in any store are stored
+# as floats, with "integral" marking the stores whose values were integers)
+def build_long_store(stores, geo, ctc):
+    s = {"geo": geo, "cols": list(stores[0]["cols"]), "geo_cols": list(stores[0]["geo_cols"]),
+        "cat_cols": list(stores[0]["cat_cols"]), "integral": {}}
+    for col in s["cols"]:
+        if col in s["cat_cols"]:
+            # merged categories are sorted, so codes keep the row order of each store
+            cats = pd.Index(np.concatenate([st[col + "_cats"] for st in stores])).unique().sort_values()
+            s[col] = np.concatenate([cats.get_indexer(st[col + "_cats"])[st[col]] for st in stores]).astype(np.int32)
+            s[col + "_cats"] = np.asarray(cats, dtype = object)
+        else:
+            s[col] = np.concatenate([st[col] for st in stores])
+            if col != "date" and s[col].dtype.kind == "f":
+                s["integral"][col] = np.array([st[col].dtype.kind in "iu" for st in stores])
+    # first row of each store and groups numbered across stores
+    n = np.array([len(st["date"]) for st in stores], dtype = np.int64)
+    s["part_start"] = np.cumsum(n) - n
+    s["group_start"] = np.concatenate([st["group_start"] + o for st, o in zip(stores, s["part_start"])]).astype(np.int64)
+    s["group_end"] = np.concatenate([st["group_end"] + o for st, o in zip(stores, s["part_start"])]).astype(np.int64)
+    group = np.repeat(np.arange(len(s["group_start"])), s["group_end"] - s["group_start"])
+    s["date_key"] = date_key(group, s["date"])
+    # timeseries order of each store, stores in the given order
+    s["orders"] = ["order"]
+    if geo == "hr":
+        part = np.repeat(np.arange(len(stores)), n)
+        s["order"] = np.lexsort((s["sub_region_1"], s["date"], s["region"], part))
+        s["order_pos"] = np.empty(len(s["date"]), dtype = np.int64)
+        s["order_pos"][s["order"]] = np.arange(len(s["date"]))
+    else:
+        s["order"] = None
+        s["order_pos"] = None
+    return index_store(s, ctc)
+
+# function: add lookup structures to a store (derived from its arrays and categories,
+# and from the pt and hr name tables in ctc)
+def index_store(s, ctc):
+    # category lookups (name to code)
+    for col in s["geo_cols"]:
+        s[col + "_index"] = {k: i for i, k in enumerate(s[col + "_cats"])}
+    # groups of each region and sub_region_1 code
+    for col in s["geo_cols"]:
+        codes = s[col][s["group_start"]]
+        s["index_" + col] = {c: np.flatnonzero(codes == c) for c in np.unique(codes)}
+    # pre-formatted date strings for every day from the first date to the last date
+    # (the string for a row is at position date - date_min)
+    s["date_min"] = int(s["date"].min()) if len(s["date"]) > 0 else 0
+    n_days = int(s["date"].max()) - s["date_min"] + 1 if len(s["date"]) > 0 else 0
+    dates = np.datetime_as_string(np.arange(s["date_min"], s["date_min"] + n_days).astype("datetime64[D]"))
+    s["date_str"] = dates.astype(object)
+    s["date_legacy"] = np.asarray([v[8:10] + "-" + v[5:7] + "-" + v[0:4] for v in s["date_str"]], dtype = object)
+    # names of geographic categories under each naming scheme
+    s["names"] = geo_names(s, ctc)
+    return s
+
+# function: read CovidTimelineCanada table with compact types
+# (name, region and sub_region_1 as categoricals, dates as int32 day ordinals and integer
+# values as the smallest integer type that holds them; float values stay float64, so
+# they are formatted the same in responses)
+def read_table(path, geo):
+    text_cols = ["name", "region", "sub_region_1"] if geo == "hr" else ["name", "region"]
+    d = pd.read_csv(path, dtype = {col: "category" for col in text_cols}, parse_dates = ["date"])
+    d["date"] = d["date"].values.astype("datetime64[D]").astype(np.int32)
+    for col in d.columns:
+        if col != "date" and d[col].dtype.kind in "iu":
+            d[col] = pd.to_numeric(d[col], downcast = "integer")
+    return d
+
+# function: table read by read_table with the types of a plain read_csv
+# (text columns as strings, dates as datetimes and integers as int64)
+def expand_table(d):
+    d = d.copy()
+    for col in d.columns:
+        if isinstance(d[col].dtype, pd.CategoricalDtype):
+            d[col] = d[col].astype(object)
+        elif col == "date":
+            d[col] = d[col].to_numpy().astype("datetime64[D]").astype("datetime64[ns]")
+        elif d[col].dtype.kind in "iu":
+            d[col] = d[col].astype(np.int64)
+    return d
+
+# function: build wide summary table (one column per stat) for a geo level
+def build_wide(tables, geo):
+    cols = ["region", "sub_region_1", "date"] if geo == "hr" else ["region", "date"]
+    d = pd.DataFrame(columns = cols)
+    for s, df in tables:
+        df = df.rename(columns = {"value": s, "value_daily": s + "_daily"})
+        df = df.drop("name", axis = 1)
+        d = pd.merge(d, df, on = cols, how = "outer")
+    return d
+
+# snapshot of CovidTimelineCanada data (tables, location keys, version, precomputed
+# stores and hashes of the files they were read from), which is not modified once published
+# a new snapshot is built entirely before it replaces the current one in a single
+# assignment, so requests that hold on to a snapshot never see a mix of old and new data
+# (filled stores and long-format stores of all stats depend on the current date or are
+# only needed by some requests, so they are built on demand and kept with the snapshot
+# they were built from)
+class Snapshot:
+
+    def __init__(self, ctc, keys_pt, keys_hr, version, store, summary, hashes):
+        self.ctc = ctc
+        self.keys_pt = keys_pt
+        self.keys_hr = keys_hr
+        self.version = version
+        self.store = store
+        self.summary = summary
+        self.hashes = hashes
+        self.store_filled = {}
+        self.summary_filled = {}
+        self.store_long = {}
+        self.store_long_filled = {}
+
+# function: valid pt and hr location keys
+def location_keys(ctc):
+    keys_pt = set(ctc["pt"]["region"].tolist())
+    keys_hr = set(ctc["hr"]["hruid"].to_list() + ['9999'])
+    return keys_pt, keys_hr
+
 # function: read CovidTimelineCanada
-def load_data_ctc(temp_dir):
+# (if a previous snapshot is given, tables whose files have not changed are reused
+# along with their stores, and only wide summary tables of geo levels with changed
+# tables are rebuilt)
+def load_data_ctc(temp_dir, previous = None):
     
     # make data available globally
-    global ctc, keys_pt, keys_hr, version_ctc
+    global snapshot
 
     # define data
     files_hr = [
@@ -66,167 +355,391 @@ def load_data_ctc(temp_dir):
         ("can", "vaccine_administration_dose_4_can.csv", "vaccine_administration_dose_4_can")
     ]
 
-    # load data
+    # find changed files
+    # (all tables are reloaded if the geo files have changed, since stores depend on them)
     root = os.path.join(temp_dir, "CovidTimelineCanada")
+    paths = {f[2]: os.path.join(root, "data", f[0], f[1]) for f in files_hr + files_pt_can}
+    paths["pt"] = os.path.join(root, "geo", "pt.csv")
+    paths["hr"] = os.path.join(root, "geo", "hr.csv")
+    hashes = {k: file_hash(v) for k, v in paths.items()}
+    if previous is None or any(hashes[k] != previous.hashes.get(k) for k in ["pt", "hr"]):
+        changed = set(paths)
+    else:
+        changed = set(k for k in paths if hashes[k] != previous.hashes.get(k))
+    print("Reading " + str(len(changed)) + " of " + str(len(paths)) + " CovidTimelineCanada files...")
+
+    # load data (unchanged tables are taken from the previous snapshot)
     ctc = {}
-    for i in range(len(files_hr)):
-        ctc[files_hr[i][2]] = pd.read_csv(
-            os.path.join(root, "data", files_hr[i][0], files_hr[i][1]),
-            dtype = {"region": str, "sub_region_1": str}, parse_dates = ["date"])
-    for i in range(len(files_pt_can)):
-        ctc[files_pt_can[i][2]] = pd.read_csv(
-            os.path.join(root, "data", files_pt_can[i][0], files_pt_can[i][1]),
-            dtype = {"region": str}, parse_dates = ["date"])
-    ctc["pt"] = pd.read_csv(os.path.join(root, "geo", "pt.csv"), dtype = str)
-    ctc["hr"] = pd.read_csv(os.path.join(root, "geo", "hr.csv"), dtype = str)
-    keys_pt = set(ctc["pt"]["region"].tolist())
-    keys_hr = set(ctc["hr"]["hruid"].to_list() + ['9999'])
+    for f in files_hr + files_pt_can:
+        ctc[f[2]] = read_table(paths[f[2]], f[0]) if f[2] in changed else previous.ctc[f[2]]
+    for k in ["pt", "hr"]:
+        ctc[k] = pd.read_csv(paths[k], dtype = str) if k in changed else previous.ctc[k]
+    keys_pt, keys_hr = location_keys(ctc)
     version_ctc = pd.read_csv(os.path.join(root, "update_time.txt"), sep="\t", header=None).head().values[0][0]
+    # build read-optimized stores
+    store = {}
+    for f in files_hr + files_pt_can:
+        store[f[2]] = build_store(ctc[f[2]], f[0], ctc) if f[2] in changed else previous.store[f[2]]
+    # build stores of wide summary tables
+    summary = {}
+    for geo in ["hr", "pt", "can"]:
+        files_geo = [f for f in files_hr + files_pt_can if f[0] == geo]
+        if not any(f[2] in changed for f in files_geo):
+            summary[geo] = previous.summary[geo]
+            continue
+        tables = [(f[2][0:-len(geo) - 1], ctc[f[2]]) for f in files_geo]
+        summary[geo] = build_store(build_wide(tables, geo), geo, ctc, orders = ["order_summary"])
+    # publish snapshot
+    snapshot = Snapshot(ctc, keys_pt, keys_hr, version_ctc, store, summary, hashes)
     
-# function: update CovidTimelineCanada data
-def update_data_ctc(temp_dir):
-    
-    # make data available globally
-    global ctc, keys_pt, keys_hr, version_ctc
+# function: update CovidTimelineCanada data (returns whether data have changed)
+# (pull = False checks a fresh clone against the current data)
+def update_data_ctc(temp_dir, pull = True):
     
     # git pull
-    print("Pulling from CovidTimelineCanada repository...")
-    repo = git.Git(os.path.join(temp_dir, "CovidTimelineCanada"))
-    repo.pull("origin", "main")
+    if pull:
+        print("Pulling from CovidTimelineCanada repository...")
+        repo = git.Git(os.path.join(temp_dir, "CovidTimelineCanada"))
+        repo.pull("origin", "main", kill_after_timeout = git_timeout)
     
     # read in updated data if version has changed
     print("Checking if CovidTimelineCanada data have changed...")
     root = os.path.join(temp_dir, "CovidTimelineCanada")
-    if (pd.read_csv(os.path.join(root, "update_time.txt"), sep="\t", header=None).head().values[0][0] != version_ctc):
+    if (pd.read_csv(os.path.join(root, "update_time.txt"), sep="\t", header=None).head().values[0][0] != snapshot.version):
         print("CovidTimelineCanada files have changed. Reloading files...")
-        load_data_ctc(temp_dir)
+        load_data_ctc(temp_dir, snapshot)
         print("CovidTimelineCanada data have been updated.")
+        return True
     else:
         print("CovidTimelineCanada data have not changed. No action required.")
+        return False
+
+# function: read datasets.json into a single dictionary (by UUID)
+def parse_datasets(content):
+    file = json.loads(content)
+    ds = {}
+    for a in file:
+        for d in file[a]:
+            for i in range(len(file[a][d])):
+                    ds[file[a][d][i]["uuid"]] = file[a][d][i]
+    return ds
+
+# function: version of datasets.json (time of its last commit)
+async def fetch_version_datasets(cycle):
+    return convert_timestamp((await cycle.get(url_version_datasets)).headers["last-modified"])
+
+# function: version of archive file index
+async def fetch_version_archive_index(cycle):
+    return (await cycle.get(url_version_archive_index)).content
 
 # function: read datasets.json
-def load_data_datasets():
+async def load_data_datasets(cycle):
     
     # make data available globally
     global datasets, version_datasets
     
     # load datasets.json into a single dictionary
     print("Downloading datasets.json...")
-    file = requests.get("https://raw.githubusercontent.com/ccodwg/Covid19CanadaArchive/master/datasets.json", headers = no_cache_headers)
-    file = json.loads(file.content)
-    ds = {}
-    for a in file:
-        for d in file[a]:
-            for i in range(len(file[a][d])):
-                    ds[file[a][d][i]["uuid"]] = file[a][d][i]
-    datasets = ds
-    version_datasets = requests.get("https://api.github.com/repos/ccodwg/Covid19CanadaArchive/commits?path=datasets.json", headers = no_cache_headers).headers["last-modified"]
-    version_datasets = convert_timestamp(version_datasets)
+    file, version = await asyncio.gather(cycle.get(url_datasets), fetch_version_datasets(cycle))
+    datasets = parse_datasets(file.content)
+    version_datasets = version
     print("File datasets.json ready.")
 
-# function: update datasets.json
-def update_data_datasets():
-    
-    ## make data available globally
-    global datasets, version_datasets
+# function: update datasets.json (returns whether data have changed)
+async def update_data_datasets(cycle):
     
     # read in updated datasets.json if version has changed
     print("Checking if datasets.json has changed...")
-    version_datasets_new = requests.get("https://api.github.com/repos/ccodwg/Covid19CanadaArchive/commits?path=datasets.json", headers = no_cache_headers).headers["last-modified"]
-    version_datasets_new = convert_timestamp(version_datasets_new)
-    if (version_datasets_new != version_datasets):
+    if (await fetch_version_datasets(cycle) != version_datasets):
         print("File datasets.json has changed. Reloading index...")
-        load_data_datasets()
+        await load_data_datasets(cycle)
         print("File datasets.json has been updated.")
+        return True
     else:
         print("File datasets.json has not changed. No action required.")
+        return False
+
+# function: path for a new file index database
+def archive_path():
+    global archive_builds
+    archive_builds += 1
+    os.makedirs(temp_dir, exist_ok = True)
+    return os.path.join(temp_dir, "archive-" + str(archive_builds) + ".db")
+
+# function: open file index database
+def open_archive(path):
+    return {"path": path, "con": archive_index.connect(path)}
 
 # function: read archive file index
-def load_data_archive_index():
+async def load_data_archive_index(cycle):
     
     ## make data available globally
-    global archive, version_archive_index, datasets
+    global archive, version_archive_index
     
-    ## load file index into "archive" dictionary
+    ## download database (streamed to disk), latest version of datasets.json and version
     print("Downloading archive file index...")
-    ## download database as temporary file
-    temp = tempfile.NamedTemporaryFile()
-    with open(temp.name, "wb") as f:
-        f.write(requests.get("https://data.opencovid.ca/archive/index.db", headers = no_cache_headers).content)
-    ## read database into DataFrame
-    archive["index"] = pd.read_sql("SELECT * FROM archive", sqlite3.connect(temp.name))
-    ## download latest version of datasets.json
-    load_data_datasets()
-    ## extract uuid, dir_parent, dir_file from datasets.json for each dataset
-    datasets_meta = pd.DataFrame.from_dict(datasets, orient = "index")[["uuid", "dir_parent", "dir_file"]]
-    ## merge dataset metadata with archive index
-    archive["index"] = pd.merge(archive["index"], datasets_meta, on = "uuid", how = "left")
-    ## for each non-duplicate file, calculate file URL
-    archive_unique = archive["index"][archive["index"]["file_duplicate"] == 0]
-    # temporarily disable pandas chained assignment warning
-    # otherwise, a sprurious warning will be printed
-    pd_option = pd.get_option('chained_assignment') # save previous value
-    pd.set_option('chained_assignment', None) # disable
-    archive_unique["file_url"] = "https://data.opencovid.ca/archive/" + archive_unique["dir_parent"] + "/" + archive_unique["dir_file"] + "/" + archive_unique["file_name"]
-    # reset pandas chained assignment warning option
-    pd.set_option('chained_assignment', pd_option) # reset
-    ## join file URL back to archive index
-    archive["index"] = pd.merge(archive["index"], archive_unique[["uuid", "file_md5", "file_size", "file_url"]], on = ["uuid", "file_md5", "file_size"], how = "left")
-    ## calculate whether file is the final unique file for a given UUID and date
-    archive["index"]["file_final_for_date"] = archive["index"].groupby(["uuid", "file_date"])["file_timestamp"].transform(max) == archive["index"]["file_timestamp"]
-    archive["index"]["file_final_for_date"] = archive["index"]["file_final_for_date"].astype(int)
-    ## reorder columns
-    archive["index"] = archive["index"][[
-        "uuid", "dir_parent", "dir_file", "file_name", "file_timestamp", "file_date", "file_duplicate", "file_final_for_date", "file_md5", "file_size", "file_url"]]
+    path = os.path.join(temp_dir, "index.db")
+    _, file_datasets, version = await asyncio.gather(
+        cycle.get(url_archive_index, path), cycle.get(url_datasets), fetch_version_archive_index(cycle))
+    ## build file index database in a worker thread
+    db = archive_path()
+    await asyncio.to_thread(archive_index.build, path, parse_datasets(file_datasets.content), db)
+    ## publish file index (built separately so requests never see a partial index)
+    ## and remove the previous database (queries still running keep it open)
+    previous = archive.get("path")
+    archive = open_archive(db)
+    if previous is not None:
+        os.remove(previous)
     ## update version
-    version_archive_index = requests.get("https://data.opencovid.ca/archive/update_time.txt", headers = no_cache_headers).content
+    version_archive_index = version
     print("File index ready.")
     
-## function: update archive file index
-def update_data_archive_index():
-    
-    ## make data available globally
-    global archive, version_archive_index
+## function: update archive file index (returns whether data have changed)
+async def update_data_archive_index(cycle):
     
     ## read in updated file index if version has changed
     print("Checking if archive file index has changed...")
-    version_archive_index_new = requests.get("https://data.opencovid.ca/archive/update_time.txt", headers = no_cache_headers).content
-    if (version_archive_index_new != version_archive_index):
+    if (await fetch_version_archive_index(cycle) != version_archive_index):
         print("Archive file index has changed. Reloading index...")
-        load_data_archive_index()
+        await load_data_archive_index(cycle)
         print("Archive file index has been updated.")
+        return True
     else:
         print("Archive file index has not changed. No action required.")
+        return False
     
-# initial data pulls
-
-## define temporary directory
-temp_dir = tempfile.TemporaryDirectory().name
-
-## CovidTimelineCanada
-print("Cloning from CovidTimelineCanada repository...")
-git.Repo.clone_from(
-    "https://github.com/ccodwg/CovidTimelineCanada.git",
-    os.path.join(temp_dir, "CovidTimelineCanada"), branch = "main", depth = 1)
-print("Clone complete. Reading in data from CovidTimelineCanada...")
-load_data_ctc(temp_dir)
-print("CovidTimelineCanada data are ready.")
-
-## datasets.json
-global datasets, version_datasets
-datasets = {}
-version_datasets = requests.get("https://api.github.com/repos/ccodwg/Covid19CanadaArchive/commits?path=datasets.json", headers = no_cache_headers).headers["last-modified"]
-load_data_datasets()
-
-## archive file index
-global archive, version_archive_index
-archive = {}
-version_archive_index = requests.get("https://data.opencovid.ca/archive/update_time.txt", headers = no_cache_headers).content
-load_data_archive_index()
-
-# schedule data updates
-scheduler = BackgroundScheduler()
-job_ctc = scheduler.add_job(update_data_ctc, "interval", minutes=5, args=[temp_dir])
-job_datasets = scheduler.add_job(update_data_datasets, "interval", minutes=5)
-job_archive_index = scheduler.add_job(update_data_archive_index, "interval", minutes=5)
-scheduler.start()
+# function: stores, tables, files and metadata of the current data (as written to a generation)
+# (with_tables also includes the CovidTimelineCanada tables, which are only needed by a loader)
+def generation_data(with_tables = False):
+    stores = {"store_" + k: v for k, v in snapshot.store.items()}
+    stores.update({"summary_" + k: v for k, v in snapshot.summary.items()})
+    tables = {"geo_pt": snapshot.ctc["pt"], "geo_hr": snapshot.ctc["hr"]}
+    files = {"archive.db": archive["path"]}
+    if with_tables:
+        tables.update({"ctc_" + k: v for k, v in snapshot.ctc.items() if k not in ["pt", "hr"]})
+    meta = {
+        "version_ctc": snapshot.version,
+        "hashes": snapshot.hashes,
+        "datasets": datasets,
+        "version_datasets": version_datasets,
+        "version_archive_index": version_archive_index.decode()
+    }
+    return stores, tables, files, meta
+
+# function: make data read from a generation the current data
+def use_generation(meta, stores, tables, files):
+    global snapshot, datasets, version_datasets, archive, version_archive_index
+    ctc = {k[len("ctc_"):]: v for k, v in tables.items() if k.startswith("ctc_")}
+    ctc.update({"pt": tables["geo_pt"], "hr": tables["geo_hr"]})
+    # rebuild lookup structures of stores (arrays stay in the mapped files)
+    store = {k[len("store_"):]: index_store(v, ctc) for k, v in stores.items() if k.startswith("store_")}
+    summary = {k[len("summary_"):]: index_store(v, ctc) for k, v in stores.items() if k.startswith("summary_")}
+    keys_pt, keys_hr = location_keys(ctc)
+    snapshot = Snapshot(ctc, keys_pt, keys_hr, meta["version_ctc"], store, summary, meta["hashes"])
+    datasets = meta["datasets"]
+    version_datasets = meta["version_datasets"]
+    archive = open_archive(files["archive.db"])
+    version_archive_index = meta["version_archive_index"].encode()
+
+# function: publish data for other processes (loader with a shared directory only)
+# and save it to the snapshot cache (unless cache = False)
+# (nothing is published until all datasets are ready)
+def publish_data(cache = True):
+    if any(v != "ready" for v in status.values()):
+        return
+    with publish_lock:
+        if shared_dir is not None:
+            stores, tables, files, meta = generation_data()
+            generation = shared.write_generation(shared_dir, counter, stores, tables, files, meta)
+            print("Published data generation " + str(generation) + ".")
+        if cache_dir is not None and cache:
+            write_cache(cache_dir)
+
+# function: save current data to a snapshot cache directory
+def write_cache(path):
+    t0 = time.perf_counter()
+    stores, tables, files, meta = generation_data(with_tables = True)
+    shared.write_generation(path, shared.map_counter(path), stores, tables, files, meta)
+    print("Saved data to snapshot cache ({:.1f} s).".format(time.perf_counter() - t0))
+
+# function: load data from a snapshot cache directory
+# (returns False if the cache is empty, unreadable or was written in another layout)
+def load_cache(path):
+    global archive
+    t0 = time.perf_counter()
+    try:
+        latest = shared.read_counter(shared.map_counter(path))
+        if latest == 0:
+            return False
+        published = shared.read_generation(path, latest)
+        if published is None or not any(k.startswith("ctc_") for k in published[2]):
+            return False
+        use_generation(*published)
+        # keep a copy of the file index database, since cache generations are replaced
+        path_archive = archive_path()
+        shared.link_or_copy(archive["path"], path_archive)
+        archive = open_archive(path_archive)
+    except (OSError, ValueError, KeyError, sqlite3.Error) as e:
+        print("Snapshot cache could not be read: " + repr(e))
+        return False
+    print("Loaded data from snapshot cache ({:.1f} s).".format(time.perf_counter() - t0))
+    return True
+
+# function: switch to the latest published data (processes that map shared data only)
+# (returns False if no data have been published yet)
+def sync_data():
+    global generation
+    if loader:
+        return True
+    latest = shared.read_counter(counter)
+    if latest == generation:
+        return generation > 0
+    with sync_lock:
+        if latest == generation:
+            return True
+        published = shared.read_generation(shared_dir, latest)
+        if published is None:
+            return False
+        use_generation(*published)
+        generation = latest
+        for k in status:
+            status[k] = "ready"
+    return True
+
+# function: clone CovidTimelineCanada repository (replacing a partial clone of a failed attempt)
+# (run through git.Git rather than git.Repo.clone_from, which does not enforce kill_after_timeout)
+def clone_ctc(temp_dir):
+    print("Cloning from CovidTimelineCanada repository...")
+    shutil.rmtree(os.path.join(temp_dir, "CovidTimelineCanada"), ignore_errors = True)
+    git.Git().clone(
+        url_ctc,
+        os.path.join(temp_dir, "CovidTimelineCanada"), branch = "main", depth = 1,
+        kill_after_timeout = git_timeout)
+
+# function: clone and read CovidTimelineCanada
+def load_ctc(temp_dir):
+    clone_ctc(temp_dir)
+    print("Clone complete. Reading in data from CovidTimelineCanada...")
+    load_data_ctc(temp_dir)
+    print("CovidTimelineCanada data are ready.")
+
+# function: update CovidTimelineCanada data (returns whether data have changed)
+# (data loaded from the snapshot cache are checked against a fresh clone)
+def refresh_ctc(temp_dir):
+    if os.path.exists(os.path.join(temp_dir, "CovidTimelineCanada", "update_time.txt")):
+        return update_data_ctc(temp_dir)
+    clone_ctc(temp_dir)
+    return update_data_ctc(temp_dir, pull = False)
+
+# function: load a dataset
+# (failed loads are retried after retry_delay seconds; data are published once all
+# datasets are ready)
+async def load_dataset(name, load, cycle):
+    while True:
+        try:
+            await load(cycle)
+            break
+        except Exception as e:
+            status[name] = "failed"
+            errors[name] = repr(e)
+            print("Loading " + name + " failed, retrying in " + str(retry_delay) + " seconds: " + repr(e))
+            await asyncio.sleep(retry_delay)
+            cycle = fetch.Cycle(client)
+    status[name] = "ready"
+    errors.pop(name, None)
+    await asyncio.to_thread(publish_data)
+
+# function: check all datasets that are ready for updates and reload changed datasets
+# (version checks run concurrently; files needed by several datasets are fetched once;
+# data are published once per cycle)
+async def refresh_data():
+    global refreshing
+    if refreshing:
+        print("Previous data update is still running. No action required.")
+        return
+    refreshing = True
+    try:
+        cycle = fetch.Cycle(client)
+        checks = {
+            "ctc": lambda: asyncio.to_thread(refresh_ctc, temp_dir),
+            "datasets": lambda: update_data_datasets(cycle),
+            "archive": lambda: update_data_archive_index(cycle)
+        }
+        checks = {k: v for k, v in checks.items() if status[k] == "ready"}
+        results = await asyncio.gather(*[v() for v in checks.values()], return_exceptions = True)
+        for k, res in zip(checks, results):
+            if isinstance(res, Exception):
+                errors[k] = repr(res)
+                print("Updating " + k + " failed: " + repr(res))
+            else:
+                errors.pop(k, None)
+        if any(res is True for res in results):
+            await asyncio.to_thread(publish_data)
+    finally:
+        refreshing = False
+
+# function: check for updates every refresh_interval seconds
+async def refresh_loop():
+    while True:
+        await asyncio.sleep(refresh_interval)
+        await refresh_data()
+
+# function: wait for the first data published by the loader process
+async def wait_for_shared():
+    print("Waiting for data published by the loader process...")
+    while not sync_data():
+        await asyncio.sleep(1)
+    print("Shared data generation " + str(generation) + " is ready.")
+
+# function: start loading data (called when the app starts)
+# (datasets are loaded concurrently and independently in background tasks, followed by
+# updates every refresh_interval seconds; transport can replace the HTTP transport)
+def start_data(transport = None):
+    global loader, counter, temp_dir, client, tasks, refresh_task
+
+    ## decide whether this process loads data or maps data published by the loader
+    loader = shared_dir is None or shared.acquire_loader(shared_dir)
+    if shared_dir is not None:
+        counter = shared.map_counter(shared_dir)
+
+    ## other processes map the data published by the loader
+    if not loader:
+        tasks = [asyncio.create_task(wait_for_shared())]
+        return
+
+    ## define temporary directory and HTTP client
+    temp_dir = tempfile.TemporaryDirectory().name
+    client = fetch.make_client(transport)
+
+    ## start from the snapshot cache and check the sources in the background
+    if cache_dir is not None and load_cache(cache_dir):
+        for k in status:
+            status[k] = "ready"
+        publish_data(cache = False)
+        tasks = [asyncio.create_task(refresh_data())]
+
+    ## load CovidTimelineCanada, datasets.json and the archive file index
+    else:
+        cycle = fetch.Cycle(client)
+        tasks = [
+            asyncio.create_task(load_dataset("ctc", lambda cycle: asyncio.to_thread(load_ctc, temp_dir), cycle)),
+            asyncio.create_task(load_dataset("datasets", load_data_datasets, cycle)),
+            asyncio.create_task(load_dataset("archive", load_data_archive_index, cycle))
+        ]
+    refresh_task = asyncio.create_task(refresh_loop())
+
+# function: stop loading and updating data (called when the app stops)
+async def stop_data():
+    for t in tasks + [refresh_task]:
+        if t is not None:
+            t.cancel()
+    if client is not None:
+        await client.aclose()
+
+# function: load all data and wait until they are ready (for scripts, e.g., benchmarks)
+def load_data():
+    async def run():
+        start_data()
+        await asyncio.gather(*tasks)
+        await stop_data()
+    asyncio.run(run())
@@ -0,0 +1,100 @@
+# fetch upstream data over HTTP (pooled client, timeouts and retry with backoff)
+import asyncio
+import os
+import httpx
+
+# define no cache headers
+no_cache_headers = {
+    "Cache-Control": "no-cache",
+    "Pragma": "no-cache"
+}
+
+# timeouts of requests (in seconds)
+timeout = httpx.Timeout(60.0, connect = 10.0)
+
+# retries of failed requests (connection errors, timeouts, 429 and 5xx responses),
+# waiting backoff seconds before the first retry and twice as long before each next one
+retries = 3
+backoff = 1.0
+
+# function: create pooled HTTP client
+# (transport can be replaced, e.g., by a local stub in tests)
+def make_client(transport = None):
+    return httpx.AsyncClient(
+        headers = no_cache_headers,
+        timeout = timeout,
+        limits = httpx.Limits(max_connections = 10, max_keepalive_connections = 5),
+        follow_redirects = True,
+        transport = transport)
+
+# size of chunks of downloads streamed to disk (in bytes)
+chunk_size = 1024 * 1024
+
+# last response of each url with an ETag or Last-Modified header, used for conditional
+# requests (a 304 response is answered with the last response, so callers always get the
+# current headers and content; for downloads, the content is the file at the same path)
+last = {}
+
+# function: request headers that make a request conditional on the last response
+def conditional_headers(url, path = None):
+    prev = last.get(url)
+    if prev is None or (path is not None and not os.path.exists(path)):
+        return {}
+    headers = {}
+    if "etag" in prev.headers:
+        headers["If-None-Match"] = prev.headers["etag"]
+    if "last-modified" in prev.headers:
+        headers["If-Modified-Since"] = prev.headers["last-modified"]
+    return headers
+
+# function: send GET request (streaming the body to path if given)
+async def send(client, url, headers, path = None):
+    if path is None:
+        return await client.get(url, headers = headers)
+    async with client.stream("GET", url, headers = headers) as response:
+        if response.status_code != 200:
+            await response.aread()
+            return response
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        with open(path + ".part", "wb") as f:
+            async for chunk in response.aiter_bytes(chunk_size):
+                f.write(chunk)
+        os.replace(path + ".part", path)
+        return response
+
+# function: GET url, retrying with backoff (raises on failure and on error responses)
+# (if path is given, the body is streamed to a file at path instead of read into memory)
+async def get(client, url, path = None):
+    headers = conditional_headers(url, path)
+    for attempt in range(retries + 1):
+        try:
+            response = await send(client, url, headers, path)
+            if response.status_code == 304 and headers:
+                return last[url]
+            if response.status_code != 429 and response.status_code < 500:
+                response.raise_for_status()
+                if "etag" in response.headers or "last-modified" in response.headers:
+                    last[url] = response
+                return response
+            error = httpx.HTTPStatusError(
+                "Server error " + str(response.status_code) + " for url " + url,
+                request = response.request, response = response)
+        except httpx.TransportError as e:
+            error = e
+        if attempt == retries:
+            raise error
+        await asyncio.sleep(backoff * 2 ** attempt)
+
+# fetches of one refresh cycle
+# (each url is fetched at most once per cycle, however many datasets need it)
+class Cycle:
+
+    def __init__(self, client):
+        self.client = client
+        self.tasks = {}
+
+    async def get(self, url, path = None):
+        if url not in self.tasks:
+            self.tasks[url] = asyncio.ensure_future(get(self.client, url, path))
+        # one caller being cancelled does not cancel the fetch for the others
+        return await asyncio.shield(self.tasks[url])
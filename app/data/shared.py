@@ -0,0 +1,163 @@
+# share data between processes (e.g., gunicorn workers) through memory-mapped files
+# one loader process downloads and builds the data and publishes each version as a new
+# generation; other processes map the latest generation without copying its arrays
+# layout of the shared directory:
+#   lock: held by the loader process while it lives
+#   generation: latest complete generation (64-bit counter, memory-mapped by all processes)
+#   <generation>/meta.json: versions, datasets and metadata of stores and tables
+#   <generation>/<name>.arrow: row arrays of a store or columns of a table (Arrow IPC file)
+#   <generation>/<name>: other files (e.g., the archive file index database)
+import fcntl
+import json
+import mmap
+import os
+import shutil
+import struct
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.ipc
+
+# version of the generation layout (generations written in another layout are not read)
+layout = 3
+
+# lock file of the loader process (kept open so the lock is held until the process exits)
+loader_lock = None
+
+# function: try to become the loader process for a shared directory
+def acquire_loader(shared_dir):
+    global loader_lock
+    os.makedirs(shared_dir, mode = 0o700, exist_ok = True)
+    f = open(os.path.join(shared_dir, "lock"), "a")
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return False
+    loader_lock = f
+    return True
+
+# function: map generation counter of a shared directory (0 until the first generation is published)
+def map_counter(shared_dir):
+    os.makedirs(shared_dir, mode = 0o700, exist_ok = True)
+    fd = os.open(os.path.join(shared_dir, "generation"), os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        if os.fstat(fd).st_size < 8:
+            os.ftruncate(fd, 8)
+        return mmap.mmap(fd, 8)
+    finally:
+        os.close(fd)
+
+# function: read generation counter
+def read_counter(counter):
+    return struct.unpack_from("<q", counter)[0]
+
+# function: split store into row arrays and JSON metadata
+# (lookup structures are not stored, they are rebuilt from the arrays by the reader)
+def store_parts(s):
+    rows = list(s["cols"]) + ["date_key"]
+    for o in s["orders"]:
+        if s[o] is not None:
+            rows = rows + [o, o + "_pos"]
+    meta = {
+        "geo": s["geo"],
+        "cols": s["cols"],
+        "geo_cols": s["geo_cols"],
+        "cat_cols": s["cat_cols"],
+        "orders": s["orders"],
+        "rows": rows,
+        "cats": {col: s[col + "_cats"].tolist() for col in s["cat_cols"]},
+        "group_start": s["group_start"].tolist(),
+        "group_end": s["group_end"].tolist()
+    }
+    return {k: s[k] for k in rows}, meta
+
+# function: rebuild store from row arrays and JSON metadata
+def store_from_parts(arrays, meta):
+    s = {"geo": meta["geo"], "cols": meta["cols"], "geo_cols": meta["geo_cols"],
+        "cat_cols": meta["cat_cols"], "orders": meta["orders"]}
+    for col in meta["cat_cols"]:
+        s[col + "_cats"] = np.asarray(meta["cats"][col], dtype = object)
+    s["group_start"] = np.asarray(meta["group_start"], dtype = np.int64)
+    s["group_end"] = np.asarray(meta["group_end"], dtype = np.int64)
+    for o in meta["orders"]:
+        s[o] = None
+        s[o + "_pos"] = None
+    for k in meta["rows"]:
+        s[k] = arrays[k]
+    return s
+
+# function: write arrays or table to an Arrow IPC file
+def write_arrow(path, table):
+    with pa.OSFile(path, "wb") as f:
+        with pa.ipc.new_file(f, table.schema) as writer:
+            writer.write_table(table)
+
+# function: map Arrow IPC file as a table (buffers point into the mapped file)
+def read_arrow(path):
+    return pa.ipc.open_file(pa.memory_map(path, "r")).read_all()
+
+# function: column of a mapped table as a read-only NumPy array (without copying)
+def column_array(table, name):
+    col = table.column(name)
+    if col.num_chunks == 0:
+        return np.empty(0, dtype = col.type.to_pandas_dtype())
+    return col.chunk(0).to_numpy(zero_copy_only = True)
+
+# function: hard link file (or copy it where links are not possible, e.g., across file systems)
+def link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+# function: write a new generation and make it the latest
+# (stores are dicts of stores by name, tables are DataFrames by name, files are paths of
+# files by name; the generation is complete before the counter changes, so readers never
+# see a partial generation)
+def write_generation(shared_dir, counter, stores, tables, files, meta):
+    generation = read_counter(counter) + 1
+    path = os.path.join(shared_dir, str(generation))
+    shutil.rmtree(path, ignore_errors = True)
+    os.makedirs(path, mode = 0o700)
+    meta = dict(meta, layout = layout, stores = {}, tables = {}, files = list(files))
+    for name, s in stores.items():
+        arrays, meta["stores"][name] = store_parts(s)
+        write_arrow(os.path.join(path, name + ".arrow"), pa.table(arrays))
+    for name, d in tables.items():
+        meta["tables"][name] = [col for col in d.columns if d[col].dtype == object or isinstance(d[col].dtype, pd.StringDtype)]
+        write_arrow(os.path.join(path, name + ".arrow"), pa.Table.from_pandas(d, preserve_index = False))
+    for name, src in files.items():
+        link_or_copy(src, os.path.join(path, name))
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump(meta, f)
+    struct.pack_into("<q", counter, 0, generation)
+    counter.flush()
+    # remove older generations (processes still using one keep their mappings)
+    for name in os.listdir(shared_dir):
+        if name.isdigit() and int(name) < generation - 1:
+            shutil.rmtree(os.path.join(shared_dir, name), ignore_errors = True)
+    return generation
+
+# function: map a generation
+# (returns metadata, stores with arrays mapped from the files, tables read as DataFrames and
+# paths of other files, or None if the generation was written in another layout)
+def read_generation(shared_dir, generation):
+    path = os.path.join(shared_dir, str(generation))
+    with open(os.path.join(path, "meta.json")) as f:
+        meta = json.load(f)
+    if meta.get("layout") != layout:
+        return None
+    stores = {}
+    for name, m in meta["stores"].items():
+        table = read_arrow(os.path.join(path, name + ".arrow"))
+        stores[name] = store_from_parts({k: column_array(table, k) for k in m["rows"]}, m)
+    tables = {}
+    for name, text_cols in meta["tables"].items():
+        d = read_arrow(os.path.join(path, name + ".arrow")).to_pandas()
+        # missing text values are read as None, restore NaN as in the loader's tables
+        for col in text_cols:
+            d[col] = d[col].where(d[col].notna(), np.nan)
+        tables[name] = d
+    files = {name: os.path.join(path, name) for name in meta["files"]}
+    return meta, stores, tables, files
@@ -1,13 +1,24 @@
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import FastAPI, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from starlette.responses import FileResponse, StreamingResponse
+from starlette.responses import FileResponse, JSONResponse, Response, StreamingResponse
+from pydantic import BaseModel, ConfigDict, Field, create_model
+from contextlib import asynccontextmanager
 from datetime import date, datetime
+from typing import Annotated, Literal, Union
 import pytz
 import re
-import io
 import csv
+import asyncio
+import inspect
+import itertools
+import numpy as np
 import pandas as pd
-from app.data import data
+from app.data import archive_index, data, fetch
+from app.cache import ResponseCache
+from app.compress import CompressionMiddleware, accept_encoding, compress, minimum_size
+from app import offload
+from app.conditional import http_date, make_etag, not_modified, version_datetime
+from app.serialize import RawJSON, arrow_chunks, json_bytes, json_lines, json_records, json_rows
 
 tags_metadata = [
     {"name": "CovidTimelineCanada", "description": "New Canadian COVID-19 dataset from the COVID-19 Canada Open Data Working Group (see https://github.com/ccodwg/CovidTimelineCanada)"},
@@ -15,26 +26,149 @@ tags_metadata = [
     {"name": "Version", "description": "Update times corresponding to the data available from each route"}
 ]
 
+# load data in the background while the app starts serving
+# (routes return 503 until the data they use are ready, see /ready)
+@asynccontextmanager
+async def lifespan(app):
+    data.start_data()
+    yield
+    await data.stop_data()
+
 app = FastAPI(
     title = "COVID-19 Canada Open Data Working Group API",
     version = "0.2.0",
     docs_url = "/",
     openapi_tags = tags_metadata,
-    recdoc_url = None
+    recdoc_url = None,
+    lifespan = lifespan
 )
 
+# max age of responses in shared and browser caches (in seconds)
+# (same as the interval between checks for updates)
+cache_max_age = data.refresh_interval
+
+# function: get CovidTimelineCanada data snapshot for a request
+# (the first call takes the current snapshot, later calls for the same request return
+# the same snapshot, even if new data have been published in the meantime)
+def request_snapshot(request):
+    if "snapshot" not in request.scope:
+        request.scope["snapshot"] = data.snapshot
+    return request.scope["snapshot"]
+
+# function: get archive file index for a request
+# (like request_snapshot, all calls for the same request return the same index and version)
+def request_archive(request):
+    if "archive" not in request.scope:
+        request.scope["archive"] = (data.archive, data.version_archive_index)
+    return request.scope["archive"]
+
+# function: get encoding to compress a response with for a request
+# (sub-queries of a batch request are not compressed, the batch response is)
+def request_encoding(request):
+    if "batch" in request.scope:
+        return None
+    return accept_encoding(request.headers.get("accept-encoding", ""))
+
+# answer conditional requests for data routes
+# (validators are computed before the response is built; the CovidTimelineCanada
+# and archive routes use the same data as the validators, while for other routes a response
+# can only be labelled with an older version than its data, never a newer one;
+# this middleware is added before CORS so that 304 responses also carry CORS headers)
+@app.middleware("http")
+async def conditional_requests(request, call_next):
+    route = request.url.path.strip("/")
+    if request.method != "GET" or route not in routes:
+        return await call_next(request)
+    # get data versions for route
+    if route in ["timeseries", "summary"]:
+        versions = [request_snapshot(request).version]
+    elif route == "datasets":
+        versions = [data.version_datasets]
+    elif route == "archive":
+        versions = [request_archive(request)[1]]
+    else:
+        versions = [request_snapshot(request).version, data.version_datasets, data.version_archive_index]
+    modified = [version_datetime(v) for v in versions]
+    last_modified = None if None in modified else max(modified)
+    ## filled data extend to the current date, so they also change at midnight
+    if route in ["timeseries", "summary"]:
+        today = get_datetime().date()
+        versions = versions + [today]
+        if last_modified is not None:
+            last_modified = max(last_modified, pytz.timezone("America/Toronto").localize(
+                datetime(today.year, today.month, today.day)))
+    etag = make_etag(route, versions, request.query_params)
+    # return 304 if client copy is current (with the ETag in the form the client holds),
+    # otherwise build response
+    matched = not_modified(request.headers, etag, last_modified)
+    if matched is not None:
+        response = Response(status_code = 304)
+        etag = matched
+    else:
+        response = await call_next(request)
+        if response.status_code != 200:
+            return response
+    response.headers["ETag"] = etag
+    if last_modified is not None:
+        response.headers["Last-Modified"] = http_date(last_modified)
+    response.headers["Cache-Control"] = "public, max-age=" + str(cache_max_age)
+    return response
+
+# return 503 for data routes until the datasets they use are ready
+# (added after the conditional requests middleware so that it runs first)
+@app.middleware("http")
+async def require_data(request, call_next):
+    route = request.url.path.strip("/")
+    if route in route_datasets:
+        # switch to the latest data published by the loader process (if data are shared)
+        data.sync_data()
+        loading = [k for k in route_datasets[route] if data.status[k] != "ready"]
+        if loading:
+            return JSONResponse(
+                {"detail": "Data are loading. Please try again later.", "loading": loading},
+                status_code = 503, headers = {"Retry-After": str(retry_after)})
+    return await call_next(request)
+
 origins = ["*"]
 
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
-    allow_methods=["GET"],
+    allow_methods=["GET", "POST"],
     allow_headers=["*"],
 )
 
+# compress responses (added last so that it wraps all other middleware)
+app.add_middleware(CompressionMiddleware)
+
 # define routes
 routes = ["timeseries", "summary", "datasets", "archive", "version"]
 
+# datasets used by each route
+route_datasets = {
+    "timeseries": ["ctc"],
+    "summary": ["ctc"],
+    "datasets": ["datasets"],
+    "archive": ["archive"],
+    "version": ["ctc", "datasets", "archive"]
+}
+
+# seconds after which clients should retry while data are loading
+retry_after = 5
+
+# number of rows written per batch of streamed (CSV, NDJSON) output
+stream_batch_rows = 10000
+
+# cache of serialized JSON responses for CovidTimelineCanada routes
+# (also holds the compressed variants of each response; entries belong to the version
+# of the current snapshot)
+cache = ResponseCache(
+    max_bytes = 256 * 1024 * 1024,
+    current = lambda: data.snapshot.version if data.snapshot is not None else None)
+
+# compression levels for cached responses (compressed once per data version)
+cache_compress_levels = {"gzip": 6, "br": 9}
+
 # define common functions
 
 ## no results for query text
@@ -121,141 +255,43 @@ query_hr_names = Query(
 )
 query_fmt = Query(
     "json",
-    description = "Format to return data in. Can be 'json' (default) or 'csv'. Note that 'csv' will not return any metadata such as the update time.",
-    enum = ["json", "csv"]
+    description = "Format to return data in. Can be 'json' (default), 'csv', 'ndjson' (newline-delimited JSON, one record per line), 'arrow' (Apache Arrow IPC stream) or 'parquet' (Apache Parquet). Note that formats other than 'json' will not return any metadata such as the update time. 'arrow' and 'parquet' return typed columns (dates as dates, regions dictionary-encoded) and leave missing values as nulls.",
+    enum = ["json", "csv", "ndjson", "arrow", "parquet"]
 )
 
 # define common functions
 
-# function: filter by date
-def date_filter(d, date, after, before, date_invalid_returns_latest = False):
-    # HACK: ensure date column is right type
-    if not pd.api.types.is_datetime64_ns_dtype(d["date"]):
-        d["date"] = pd.to_datetime(d["date"])
-    # date: specific date or latest/earlier x days
-    if date:
-        # case: date is date
-        if re.match(r"^\d{4}-\d{2}-\d{2}$", date):
-            d = d[d["date"].dt.date == pd.to_datetime(date).date()]
-        # case: date is positive integer
-        elif date.isdigit():
-            # get grouping columns
-            geo_cols = [x for x in ['region', 'sub_region_1', 'sub_region_2'] if x in d.columns]
-            d = d.groupby(geo_cols).tail(int(date))
-        # case: date is negative integer
-        elif date.startswith("-") and date[1:].isdigit():
-            geo_cols = [x for x in ['region', 'sub_region_1', 'sub_region_2'] if x in d.columns]
-            d = d.groupby(geo_cols).head(-int(date))
-        # case: date is invalid
-        else:
-            if date_invalid_returns_latest:
-                # if invalid value for date, return latest (default behaviour for summary route)
-                geo_cols = [x for x in ['region', 'sub_region_1', 'sub_region_2'] if x in d.columns]
-                d = d.groupby(geo_cols).tail(1)
-            else:
-                # if invalid value for date, ignore parameter (default behaviour for timeseries route)
-                pass
-    if after:
-        d = d[d["date"].dt.date >= after]
-    if before:
-        d = d[d["date"].dt.date <= before]
-    return d
-
-# function: filter by location
-def loc_filter(d, geo, loc):
-    for i in range(len(loc)):
-        loc[i] = loc[i].upper()
+# function: name arrays (name of each category code) of the geographic columns of a store
+# for the requested pt and hr names
+def convert_names(s, geo, pt_names = "short", hr_names = "hruid"):
+    if pt_names not in ["short", "canonical", "pruid", "ccodwg"]:
+        raise HTTPException(status_code = 400, detail = "Invalid pt_names")
+    names = {"region": s["names"]["region"][pt_names]}
     if geo == "hr":
-        k_pt = [x for x in loc if x in data.keys_pt]
-        k_hr = [x for x in loc if x in data.keys_hr]
-        if len(k_pt) == 0 and len(k_hr) == 0:
-            raise HTTPException(status_code = 400, detail = "Invalid loc")
-        return d[d["region"].isin(k_pt) | d["sub_region_1"].isin(k_hr)]
-    elif geo == "pt":
-        k_pt = [x for x in loc if x in data.keys_pt]
-        if len(k_pt) == 0:
-            raise HTTPException(status_code = 400, detail = "Invalid loc")
-        return d[d["region"].isin(k_pt)]
-    elif geo == "can":
-        return d
-    else:
-        raise HTTPException(status_code = 400, detail = "Invalid geo")
-
-# function: convert names (hr, pt, can)
-def convert_names(d, geo, pt_names = "short", hr_names = "hruid"):
-    if geo in ["hr", "pt"]:
-        # convert pt names
-        pt = data.ctc["pt"]
-        if pt_names == "short":
-            col_pt = None
-        elif pt_names == "canonical":
-            col_pt = "name_canonical"
-        elif pt_names == "pruid":
-            col_pt = "pruid"
-        elif pt_names == "ccodwg":
-            col_pt = "name_ccodwg"
-        else:
-            raise HTTPException(status_code = 400, detail = "Invalid pt_names")
-        if col_pt:
-            pt = pt[["region", col_pt]]
-            d = d.merge(pt, on = "region", how = "left")
-            d["region"] = d[col_pt]
-            d = d.drop(col_pt, axis = 1)
-        # convert hr names
-        if geo == "hr":
-            hr = data.ctc["hr"]
-            if hr_names == "hruid":
-                col_hr = None
-            elif hr_names == "canonical":
-                col_hr = "name_canonical"
-                unknown = "Unknown"
-            elif hr_names == "short":
-                col_hr = "name_short"
-                unknown = "Unknown"
-            elif hr_names == "ccodwg":
-                col_hr = "name_ccodwg"
-                unknown = "Not Reported"
-            else:
-                raise HTTPException(status_code = 400, detail = "Invalid hr_names")
-            if col_hr:
-                hr = hr[["hruid", col_hr]]
-                d = d.merge(hr, left_on = "sub_region_1", right_on = "hruid", how = "left")
-                d["sub_region_1"] = d[col_hr]
-                d = d.drop(["hruid", col_hr], axis = 1)
-                d["sub_region_1"] = d["sub_region_1"].fillna(unknown)
-    elif geo == "can":
-        if pt_names == "short":
-            d["region"] = "CAN"
-        elif pt_names.isin(["canonical", "ccodwg"]):
-            d["region"] = "Canada"
-        elif pt_names == "pruid":
-            d["region"] = 1
-        else:
-            raise HTTPException(status_code = 400, detail = "Invalid pt_names")
-    # return data
-    return d
+        if hr_names not in ["hruid", "canonical", "short", "ccodwg"]:
+            raise HTTPException(status_code = 400, detail = "Invalid hr_names")
+        names["sub_region_1"] = s["names"]["sub_region_1"][hr_names]
+    return names
 
 # function: sort rows by region, date, lower geography
-def sort_rows(d, geo, legacy):
+# (after the columns in by, if given)
+def sort_rows(d, geo, legacy, by = []):
     if geo == "hr":
         if legacy:
-            d = d.sort_values(["region", "sub_region_1", "date"])
+            d = d.sort_values(by + ["region", "sub_region_1", "date"])
         else:
-            d = d.sort_values(["region", "date", "sub_region_1"])
+            d = d.sort_values(by + ["region", "date", "sub_region_1"])
     elif geo == "pt":
-        d = d.sort_values(["region", "date"])
+        d = d.sort_values(by + ["region", "date"])
     elif geo == "can":
-        d = d.sort_values(["date"])
+        d = d.sort_values(by + ["date"])
     else:
         raise HTTPException(status_code = 400, detail = "Invalid geo")
     return d
 
-# function: format date column for response
-def format_date_col(d, date_format = "%Y-%m-%d"):
-    d["date"] = d["date"].dt.strftime(date_format)
-    return d
-
 # fill missing dates
+# (builds the dense location x date grid as arrays, scatters known values into
+# it by position and carries cumulative values forward within each location)
 def fill_dates(d, geo):
     if geo == "hr":
         cols = ["name", "region", "sub_region_1", "date"]
@@ -270,35 +306,57 @@ def fill_dates(d, geo):
         raise HTTPException(status_code = 400, detail = "Invalid geo")
     if "name" not in d.columns:
         cols.remove("name")
-    df = d[cols[0:len(cols) - 1]].drop_duplicates()
-    df_rows = len(df)
-    dates = pd.date_range(
-        d["date"].min(), get_datetime().date(), freq = "d").to_list()
-    df = pd.concat([df] * len(dates), ignore_index = True)
-    df = df.sort_values(cols[0:len(cols) - 1])
-    df["date"] = dates * df_rows
+    keys = cols[0:len(cols) - 1]
     # HACK: ensure date column is correct type
-    if not pd.api.types.is_datetime64_ns_dtype(d["date"]):
-        d["date"] = pd.to_datetime(d["date"])
-    if not pd.api.types.is_datetime64_ns_dtype(df["date"]):
-        df["date"] = pd.to_datetime(df["date"])
-    d = pd.merge(df, d, how = "left", on = cols)
-    d = d.sort_values(by = cols)
-    daily_cols = [x for x in d.columns if re.match("_daily$", x)]
-    d[daily_cols] = d[daily_cols].fillna(0) # daily values should be 0
-    if "value" in d.columns:
-        # for timeseries route
-        d["value"] = d.groupby(cols[0:len(cols) - 1])["value"].transform(lambda x: x.ffill())
-    else:
-        # for summary route
-        d[stats] = d.groupby(cols[0:len(cols) - 1])[stats].transform(lambda x: x.ffill()) # carry cumulative values forward
-    d = d.fillna(value = 0) # fill cumulative values not filled above
-    return d
+    dates = d["date"]
+    if not pd.api.types.is_datetime64_ns_dtype(dates):
+        dates = pd.to_datetime(dates)
+    day = dates.values.astype("datetime64[D]").astype(np.int64)
+    start = day.min()
+    n_days = max(int(data.day_ordinal(get_datetime().date())) - start + 1, 0)
+    # number locations in sorted order
+    code = np.zeros(len(d), dtype = np.int64)
+    for col in keys:
+        c, u = pd.factorize(d[col], sort = True)
+        code = code * len(u) + c
+    _, first, key = np.unique(code, return_index = True, return_inverse = True)
+    n_rows = len(first) * n_days
+    # position of each known value in the grid (dates after the last grid date are dropped)
+    pos = key * n_days + (day - start)
+    keep = day - start < n_days
+    pos = pos[keep]
+    complete = len(np.unique(pos)) == n_rows
+    # build grid
+    out = {}
+    for col in keys:
+        out[col] = np.repeat(d[col].to_numpy()[first], n_days)
+    out["date"] = np.tile(np.arange(start, start + n_days).astype("datetime64[D]"), len(first)).astype("datetime64[ns]")
+    # first grid row of each location (where forward fills restart)
+    loc_start = np.repeat(np.arange(len(first)) * n_days, n_days)
+    ffill_cols = ["value"] if "value" in d.columns else stats
+    for col in [x for x in d.columns if x not in cols]:
+        v = d[col].to_numpy()[keep]
+        if complete:
+            x = np.empty(n_rows, dtype = v.dtype)
+        else:
+            x = np.full(n_rows, np.nan, dtype = np.float64 if v.dtype.kind in "iuf" else object)
+        x[pos] = v
+        missing = pd.isna(x)
+        if col in ffill_cols and missing.any():
+            # carry cumulative values forward: index of latest known value in each location
+            i = np.where(missing, loc_start, np.arange(n_rows))
+            np.maximum.accumulate(i, out = i)
+            x = x[i]
+            missing = pd.isna(x)
+        # fill values not filled above (daily values and leading cumulative values)
+        if missing.any():
+            x[missing] = 0
+        out[col] = x
+    return pd.DataFrame(out, columns = cols + [x for x in d.columns if x not in cols])
 
 # function: convert to legacy format
+# (date column must already be formatted as "%d-%m-%Y")
 def convert_to_legacy(d, geo, stat):
-    # format date column
-    d = format_date_col(d, "%d-%m-%Y")
     # drop value name column
     d = d.drop(columns = ["name"])
     d[["value", "value_daily"]] = d[["value", "value_daily"]].astype(int)
@@ -321,20 +379,310 @@ def convert_to_legacy(d, geo, stat):
     # return data
     return d
 
+# function: build response cache key from normalized query parameters
+def cache_key(route, geo, loc, fill, pt_names, hr_names, *params):
+    # loc is ignored for Canada-level data, otherwise order and case do not matter
+    if loc and geo != "can":
+        loc = tuple(sorted(set(x.upper() for x in loc)))
+    else:
+        loc = None
+    # hr names only apply to health region data
+    if geo != "hr":
+        hr_names = None
+    # filled data extend to the current date
+    fill_date = get_datetime().date() if fill else None
+    return (route, geo, loc, fill, fill_date, pt_names, hr_names) + params
+
+# function: JSON response from a serialized body, compressed with the client's encoding
+# (the compressed variant is cached under the same key as the body, so it is only
+# built once per data version)
+def json_response(version, key, body, encoding):
+    if encoding is None or len(body) < minimum_size:
+        return Response(body, media_type = "application/json")
+    body_enc = cache.get(version, key + (encoding,))
+    if body_enc is None:
+        body_enc = compress(body, encoding, cache_compress_levels[encoding])
+        cache.put(version, key + (encoding,), body_enc)
+    response = Response(body_enc, media_type = "application/json")
+    response.headers["Content-Encoding"] = encoding
+    return response
+
+# function: get cached JSON response (None if not cached)
+def cached_response(version, key, encoding):
+    if encoding is not None:
+        body_enc = cache.get(version, key + (encoding,))
+        if body_enc is not None:
+            response = Response(body_enc, media_type = "application/json")
+            response.headers["Content-Encoding"] = encoding
+            return response
+    body = cache.get(version, key)
+    if body is None:
+        return None
+    return json_response(version, key, body, encoding)
+
+# function: get precomputed store for a table
+# (filled stores are built from the unfilled store on first use and rebuilt when the date changes)
+def get_store(snap, key, geo, fill):
+    if not fill:
+        return snap.store[key]
+    today = get_datetime().date()
+    s = snap.store_filled.get(key)
+    if s is None or s["fill_date"] != today:
+        d = store_frame(snap.store[key], np.arange(len(snap.store[key]["date"])), typed = True)
+        s = data.build_store(fill_dates(d, geo), geo, snap.ctc)
+        s["fill_date"] = today
+        snap.store_filled[key] = s
+    return s
+
+# function: get precomputed store for the wide summary table of a geo level
+# (filled stores are built from the unfilled store on first use and rebuilt when the date changes)
+def get_summary_store(snap, geo, fill):
+    if not fill:
+        return snap.summary[geo]
+    today = get_datetime().date()
+    s = snap.summary_filled.get(geo)
+    if s is None or s["fill_date"] != today:
+        d = store_frame(snap.summary[geo], np.arange(len(snap.summary[geo]["date"])), typed = True)
+        s = data.build_store(fill_dates(d, geo), geo, snap.ctc, orders = ["order_summary"])
+        s["fill_date"] = today
+        snap.summary_filled[geo] = s
+    return s
+
+# function: get long-format store of all stats of a geo level
+# (built from the stores of each stat on first use; filled stores are rebuilt when the date changes)
+def get_long_store(snap, geo, stats_geo, fill):
+    if not fill:
+        s = snap.store_long.get(geo)
+        if s is None:
+            stores = [get_store(snap, x + "_" + geo, geo, False) for x in stats_geo]
+            s = snap.store_long[geo] = data.build_long_store(stores, geo, snap.ctc)
+        return s
+    today = get_datetime().date()
+    s = snap.store_long_filled.get(geo)
+    if s is None or s["fill_date"] != today:
+        stores = [get_store(snap, x + "_" + geo, geo, True) for x in stats_geo]
+        s = data.build_long_store(stores, geo, snap.ctc)
+        s["fill_date"] = today
+        snap.store_long_filled[geo] = s
+    return s
+
+# function: check whether the long-format store of a geo level is built (for today, if filled)
+def long_current(snap, geo, fill):
+    if fill:
+        return filled_current(snap.store_long_filled, [geo])
+    return geo in snap.store_long
+
+# function: keep selected rows of a long-format store that belong to the requested stats
+# (returns the rows grouped by stat in the requested order, keeping their order within
+# each stat, and the position of the stat of each row in the requested stats)
+def select_stats(s, idx, stats_geo, stats):
+    rank = np.full(len(stats_geo), len(stats))
+    rank[[stats_geo.index(x) for x in stats]] = np.arange(len(stats))
+    r = rank[np.searchsorted(s["part_start"], idx, side = "right") - 1]
+    o = np.argsort(r, kind = "stable")
+    o = o[r[o] < len(stats)]
+    return idx[o], r[o]
+
+# function: check whether filled stores are built for today
+def filled_current(filled, keys):
+    today = get_datetime().date()
+    return all(k in filled and filled[k]["fill_date"] == today for k in keys)
+
+# function: select rows of a precomputed store by location and date
+# (same selection as pandas filters of the tables by location and date, see
+# bench/bench_index.py, using the group index: each selected
+# group is narrowed to a row range by binary search on its sorted dates)
+def store_filter(snap, s, geo, loc, date, after, before, order = "order", date_invalid_returns_latest = False):
+    # filter by location (select groups)
+    groups = np.arange(len(s["group_start"]))
+    if loc:
+        loc = [x.upper() for x in loc]
+        k_pt = [s["region_index"][x] for x in loc if x in snap.keys_pt and x in s["region_index"]]
+        if geo == "hr":
+            k_hr = [s["sub_region_1_index"][x] for x in loc if x in snap.keys_hr and x in s["sub_region_1_index"]]
+            if not any(x in snap.keys_pt or x in snap.keys_hr for x in loc):
+                raise HTTPException(status_code = 400, detail = "Invalid loc")
+            groups = [s["index_region"][k] for k in k_pt] + [s["index_sub_region_1"][k] for k in k_hr]
+        elif geo == "pt":
+            if not any(x in snap.keys_pt for x in loc):
+                raise HTTPException(status_code = 400, detail = "Invalid loc")
+            groups = [s["index_region"][k] for k in k_pt]
+        if geo in ["hr", "pt"]:
+            groups = np.unique(np.concatenate(groups)) if groups else np.array([], dtype = np.int64)
+    start = s["group_start"][groups]
+    end = s["group_end"][groups]
+    lo, hi = start, end
+    # filter by date (narrow row range of each group)
+    if date:
+        # case: date is date
+        if re.match(r"^\d{4}-\d{2}-\d{2}$", date):
+            key = data.date_key(groups, data.day_ordinal(datetime.strptime(date, "%Y-%m-%d").date()))
+            lo = np.searchsorted(s["date_key"], key, side = "left")
+            hi = np.searchsorted(s["date_key"], key, side = "right")
+        # case: date is positive integer
+        elif date.isdigit():
+            lo = np.maximum(lo, end - int(date))
+        # case: date is negative integer
+        elif date.startswith("-") and date[1:].isdigit():
+            hi = np.minimum(hi, start - int(date))
+        # case: date is invalid
+        elif date_invalid_returns_latest:
+            # return latest (default behaviour for summary route)
+            lo = np.maximum(lo, end - 1)
+        # otherwise, ignore parameter (default behaviour for timeseries route)
+    if after:
+        key = data.date_key(groups, data.day_ordinal(after))
+        lo = np.maximum(lo, np.searchsorted(s["date_key"], key, side = "left"))
+    if before:
+        key = data.date_key(groups, data.day_ordinal(before))
+        hi = np.minimum(hi, np.searchsorted(s["date_key"], key, side = "right"))
+    # expand row ranges into row positions
+    n = np.maximum(hi - lo, 0)
+    idx = np.arange(n.sum()) + np.repeat(lo - np.cumsum(n) + n, n)
+    # put rows in response order
+    pos = s[order + "_pos"]
+    order = s[order]
+    if order is None:
+        return idx
+    if len(idx) * 8 > len(order):
+        mask = np.zeros(len(order), dtype = bool)
+        mask[idx] = True
+        return order[mask[order]]
+    return idx[np.argsort(pos[idx])]
+
+# function: select rows of a precomputed store for a request
+# (sub-queries of a batch request share their selections: rows of the same store are
+# only selected once for the same locations and dates)
+def request_filter(request, snap, s, geo, loc, date, after, before, order = "order", date_invalid_returns_latest = False):
+    if "batch" not in request.scope:
+        return store_filter(snap, s, geo, loc, date, after, before, order, date_invalid_returns_latest)
+    selections = request.scope["batch"]["selections"]
+    key = (id(s), tuple(sorted(set(x.upper() for x in loc))) if loc else None,
+        date, after, before, order, date_invalid_returns_latest)
+    # (the store is kept with its rows, so the key cannot match a different store)
+    selected = selections.get(key)
+    if selected is None or selected[0] is not s:
+        selected = selections[key] = (s, store_filter(
+            snap, s, geo, loc, date, after, before, order, date_invalid_returns_latest))
+    return selected[1]
+
+# function: build response frame from selected rows of a precomputed store
+# (typed: return dates as dates instead of formatted strings; names: name arrays of
+# geographic columns, as given by convert_names)
+def store_frame(s, idx, legacy = False, typed = False, names = {}):
+    d = {}
+    for col in s["cols"]:
+        if col == "date" and typed:
+            d[col] = s["date"][idx].astype("datetime64[D]")
+        elif col == "date":
+            d[col] = s["date_legacy" if legacy else "date_str"][s["date"][idx] - s["date_min"]]
+        elif col in s["cat_cols"]:
+            d[col] = names.get(col, s[col + "_cats"])[s[col][idx]]
+        else:
+            d[col] = s[col][idx]
+    return pd.DataFrame(d, columns = s["cols"])
+
+# function: check whether stores are already in response order for the requested names
+def names_presorted(geo, pt_names, hr_names):
+    return geo == "can" or (pt_names == "short" and (geo != "hr" or hr_names == "hruid"))
+
+# function: build timeseries frame from selected rows of a store
+# (types: common types of value columns across the stats of a response)
+def timeseries_frame(st, idx, geo, stat, legacy, pt_names, hr_names, types = {}, typed = False):
+    # build frame with formatted date column and converted pt, hr names
+    d = store_frame(st, idx, legacy, typed, convert_names(st, geo, pt_names, hr_names))
+    # sort rows (stores are pre-sorted for default names and for legacy format)
+    if not legacy and not names_presorted(geo, pt_names, hr_names):
+        d = sort_rows(d, geo, legacy)
+    # convert to legacy format if requested
+    if legacy:
+        d = convert_to_legacy(d, geo, stat)
+    # use a common type for columns that are floats in any stat
+    for col, t in types.items():
+        d[col] = d[col].astype(t)
+    return d
+
+# function: build summary frame from selected rows of a store
+# (types: types of value columns in typed output)
+def summary_frame(st, idx, geo, fill, pt_names, hr_names, nan_cols = [], typed = False, types = {}):
+    # build frame with formatted date column and converted pt, hr names
+    d = store_frame(st, idx, typed = typed, names = convert_names(st, geo, pt_names, hr_names))
+    for col, t in types.items():
+        d[col] = d[col].astype(t)
+    # fill missing values (typed output keeps them as missing)
+    # (columns with missing values anywhere in the response are returned as objects)
+    if not fill and not typed:
+        d = d.fillna(value = "")
+        for col in nan_cols:
+            d[col] = d[col].astype(object)
+    # sort and summarize data by date (stores are pre-sorted for default names)
+    if not names_presorted(geo, pt_names, hr_names):
+        if geo == "hr":
+            d = d.sort_values(by = ["date", "region", "sub_region_1"])
+        else:
+            d = d.sort_values(by = ["date", "region"])
+    return d
+
+# function: split selected rows into frames of at most stream_batch_rows rows
+# (if rows are in response order, each frame is built from its own rows;
+# otherwise the frame is built and sorted whole, then split; an empty
+# selection still gives one empty frame)
+def frame_batches(make_frame, idx, presorted):
+    if presorted:
+        for i in range(0, max(len(idx), 1), stream_batch_rows):
+            yield make_frame(idx[i:i + stream_batch_rows])
+    else:
+        d = make_frame(idx)
+        for i in range(0, max(len(d), 1), stream_batch_rows):
+            yield d.iloc[i:i + stream_batch_rows]
+
+# function: stream response body
+# (the first chunk is produced before responding, so errors are returned as such; the
+# other chunks are produced like the first, see offload.Stream)
+def stream_response(chunks, media_type):
+    first = next(chunks, "")
+    return StreamingResponse(
+        offload.Stream(itertools.chain([first], chunks)),
+            media_type = media_type)
+
 # function: format response as CSV
-def fmt_response_csv(d, file_name):
-    d = d.to_csv(
-        index = False, quoting = csv.QUOTE_NONNUMERIC, float_format = "%.0f")
-    response = StreamingResponse(
-        io.StringIO(d),
-            media_type = "text/csv")
+# (frames are written in order as they are produced; the header is taken from
+# the first non-empty frame)
+def fmt_response_csv(frames, file_name):
+    def generate():
+        header = True
+        for d in frames:
+            if len(d) == 0:
+                continue
+            yield d.to_csv(
+                index = False, header = header, quoting = csv.QUOTE_NONNUMERIC, float_format = "%.0f")
+            header = False
+        if header:
+            yield "\n"
+    response = stream_response(generate(), "text/csv")
     response.headers["Content-Disposition"] = "attachment; filename=" + file_name + ".csv"
     return response
 
+# function: format response as newline-delimited JSON (one record per line)
+def fmt_response_ndjson(frames):
+    return stream_response(
+        (json_lines(d) for d in frames if len(d) > 0), "application/x-ndjson")
+
+# function: format response as Arrow IPC stream or Parquet file
+def fmt_response_arrow(frames, fmt, file_name):
+    if fmt == "arrow":
+        media_type = "application/vnd.apache.arrow.stream"
+    else:
+        media_type = "application/vnd.apache.parquet"
+    response = stream_response(arrow_chunks(frames, fmt), media_type)
+    response.headers["Content-Disposition"] = "attachment; filename=" + file_name + "." + fmt
+    return response
+
 # define routes
 
 @app.get("/timeseries", tags=["CovidTimelineCanada"])
 async def get_timeseries(
+    request: Request,
     stat: list[str] = Query(
         ["all"],
         description = "One or more metrics to return. By default, all available metrics for the specified geographic level will be returned. Can be 'all' or one or more of the metrics listed below.\n* cases\n* deaths\n* hospitalizations\n* icu\n* tests_completed\n* vaccine_coverage_dose_1\n* vaccine_coverage_dose_2\n* vaccine_coverage_dose_3\n* vaccine_coverage_dose_4\n* vaccine_administration_total_doses\n* vaccine_administration_dose_1\n* vaccine_administration_dose_2\n* vaccine_administration_dose_3\n* vaccine_administration_dose_4",
@@ -395,114 +743,135 @@ async def get_timeseries(
         # turn off legacy parameter if requirements are not met
         legacy = False
 
-    # get and process data
+    # get stats for geo level
     if geo == "hr":
-        if "all" in stat:
-            stats = stats_hr
-        else:
-            stats = [x for x in stat if x in stats_hr]
-            if len(stats) == 0:
-                raise HTTPException(status_code = 400, detail = "Invalid stat")
-        for s in stats:
-            d = data.ctc[s + "_hr"]
-            # fill missing dates (before loc filter so not locations are excluded)
-            if fill:
-                d = fill_dates(d, geo)
-            # filter by location
-            if loc:
-                d = loc_filter(d, geo, loc)
-            # filter by date
-            d = date_filter(d, date, after, before)
-            # convert pt, hr names
-            d = convert_names(d, "hr", pt_names = pt_names, hr_names = hr_names)
-            # sort rows
-            d = sort_rows(d, geo, legacy)
-            # format date column and convert to legacy format if requested
-            if legacy:
-                d = convert_to_legacy(d, geo, stat)
-            else:
-                # format date column
-                d = format_date_col(d)
-            # add data to response
-            response["data"][s] = d.to_dict(orient = "records")
-
+        stats_geo = stats_hr
     elif geo == "pt":
-        if "all" in stat:
-            stats = stats_pt
-        else:
-            stats = [x for x in stat if x in stats_pt]
-            if len(stats) == 0:
-                raise HTTPException(status_code = 400, detail = "Invalid stat")
-        for s in stats:
-            d = data.ctc[s + "_pt"]
-            # fill missing dates (before loc filter so not locations are excluded)
-            if fill:
-                d = fill_dates(d, geo)
-            # filter by location
-            if loc:
-                d = loc_filter(d, geo, loc)
-            # filter by date
-            d = date_filter(d, date, after, before)
-            # convert pt names
-            d = convert_names(d, "pt", pt_names = pt_names)
-            # sort rows
-            d = sort_rows(d, geo, legacy)
-            # format date column and convert to legacy format if requested
-            if legacy:
-                d = convert_to_legacy(d, geo, stat)
-            else:
-                # format date column
-                d = format_date_col(d)
-            # add data to response
-            response["data"][s] = d.to_dict(orient = "records")
-    
+        stats_geo = stats_pt
     elif geo == "can":
-        if "all" in stat:
-            stats = stats_can
-        else:
-            stats = [x for x in stat if x in stats_can]
-            if len(stats) == 0:
-                raise HTTPException(status_code = 400, detail = "Invalid stat")
-        for s in stats:
-            d = data.ctc[s + "_can"]
-            # fill missing dates and loc filter won't do anything here
-            # filter by date
-            d = date_filter(d, date, after, before)
-            # convert Canada names
-            d = convert_names(d, "can", pt_names = pt_names)
-            # sort rows
-            d = sort_rows(d, geo, legacy)
-            # format date column and convert to legacy format if requested
-            if legacy:
-                d = convert_to_legacy(d, geo, stat)
-            else:
-                # format date column
-                d = format_date_col(d)
-            # add data to response
-            response["data"][s] = d.to_dict(orient = "records")
+        stats_geo = stats_can
     else:
         raise HTTPException(status_code = 400, detail = "Invalid geo")
+    if "all" in stat:
+        stats = stats_geo
+    else:
+        stats = [x for x in stat if x in stats_geo]
+        if len(stats) == 0:
+            raise HTTPException(status_code = 400, detail = "Invalid stat")
 
-    # add version to response
-    if version is True:
-        response["version"] = data.version_ctc
-    
-    # convert response to requested format
-    if fmt == "csv":
-        # combine stats into single list
-        out = []
-        for s in response["data"]:
-            for i in response["data"][s]:
-                out.append(i)
-        # format response as CSV
-        response = fmt_response_csv(
-            pd.DataFrame.from_records(out), "timeseries")
-    
-    # return response
-    return response
+    # use the same data snapshot for the whole request
+    snap = request_snapshot(request)
+    version_ctc = snap.version
+
+    # return cached response if available
+    if fmt not in ["csv", "ndjson", "arrow", "parquet"]:
+        key = cache_key(
+            "timeseries", geo, loc, fill and geo != "can", pt_names, hr_names,
+            tuple(stats), date, after, before, version, legacy)
+        encoding = request_encoding(request)
+        cached = cached_response(version_ctc, key, encoding)
+        if cached is not None:
+            return cached
+
+    # JSON responses with several stats are selected from the long-format store of all
+    # stats of the geo level and serialized in one pass
+    stats_json = list(dict.fromkeys(stats))
+    combined = fmt not in ["csv", "ndjson", "arrow", "parquet"] and len(stats_json) > 1
+
+    # build filled stores that are not built for today and the long-format store if it is
+    # not built (in a worker thread, since this reads the whole tables)
+    keys = [s + "_" + geo for s in stats]
+    if combined:
+        if not long_current(snap, geo, fill and geo != "can"):
+            await offload.run("timeseries", float("inf"), lambda: get_long_store(snap, geo, stats_geo, fill and geo != "can"))
+    elif fill and geo != "can" and not filled_current(snap.store_filled, keys):
+        await offload.run("timeseries", float("inf"), lambda: [get_store(snap, k, geo, True) for k in keys])
+
+    # select rows for each stat (before any output, so invalid queries are rejected)
+    selected = []
+    if combined:
+        # select rows of all stats at once, then keep the requested stats
+        st = get_long_store(snap, geo, stats_geo, fill and geo != "can")
+        idx = request_filter(request, snap, st, geo, loc, date, after, before)
+        idx, rank = select_stats(st, idx, stats_geo, stats_json)
+        selected.append((None, st, idx))
+    else:
+        for s in stats:
+            # get precomputed store (filled before loc filter so no locations are excluded;
+            # fill does not apply to Canada-level data)
+            st = get_store(snap, s + "_" + geo, geo, fill and geo != "can")
+            # filter by location and date
+            idx = request_filter(request, snap, st, geo, loc, date, after, before, "order_legacy" if legacy else "order")
+            selected.append((s, st, idx))
+
+    # build response (in a worker thread unless it is small)
+    def respond():
+        # convert response to requested format
+        if fmt in ["csv", "ndjson", "arrow", "parquet"]:
+            # stream stats in row batches (for CSV, Arrow and Parquet, value columns that
+            # are floats for any stat are written as floats for all stats; Arrow and
+            # Parquet take the types of the tables of the stats, as filled stores hold
+            # integer values as floats, and write other value columns as integers)
+            typed = fmt in ["arrow", "parquet"]
+            types = {}
+            if fmt != "ndjson" and not legacy:
+                stores = [snap.store[s + "_" + geo] if typed else st for s, st, idx in selected if len(idx) > 0]
+                for col in ["value", "value_daily"]:
+                    if any(x[col].dtype.kind == "f" for x in stores):
+                        types[col] = np.float64
+                    elif typed:
+                        types[col] = np.int64
+            presorted = legacy or names_presorted(geo, pt_names, hr_names)
+            frames = itertools.chain.from_iterable(
+                frame_batches(
+                    lambda i, st = st: timeseries_frame(st, i, geo, stat, legacy, pt_names, hr_names, types, typed),
+                    idx, presorted)
+                for s, st, idx in selected)
+            if typed:
+                return fmt_response_arrow(frames, fmt, "timeseries")
+            if fmt == "ndjson":
+                return fmt_response_ndjson(frames)
+            return fmt_response_csv(frames, "timeseries")
+
+        # process data (several stats are serialized in one pass, then split by stat)
+        if combined:
+            st, idx = selected[0][1:]
+            d = store_frame(st, idx, names = convert_names(st, geo, pt_names, hr_names))
+            r = rank
+            if not names_presorted(geo, pt_names, hr_names):
+                d["stat_rank"] = r
+                d = sort_rows(d, geo, legacy, by = ["stat_rank"])
+                r = d.pop("stat_rank").to_numpy()
+            # rows of stats with integer values are serialized as integers
+            parts = np.array([stats_geo.index(x) for x in stats_json])[r]
+            rows = json_rows(d, {col: v[parts] for col, v in st["integral"].items()})
+            n = np.bincount(r, minlength = len(stats_json))
+            end = np.cumsum(n)
+            for i, s in enumerate(stats_json):
+                response["data"][s] = RawJSON("[" + ",".join(rows[end[i] - n[i]:end[i]]) + "]")
+        else:
+            for s, st, idx in selected:
+                # add data to response
+                d = timeseries_frame(st, idx, geo, stat, legacy, pt_names, hr_names)
+                response["data"][s] = json_records(d)
+
+        # add version to response
+        if version is True:
+            response["version"] = version_ctc
+
+        # serialize response and add to cache
+        body = json_bytes(response)
+        cache.put(version_ctc, key, body)
+        
+        # return response
+        return json_response(version_ctc, key, body, encoding)
+
+    cost = sum(len(idx) * len(st["cols"]) for s, st, idx in selected)
+    return await offload.run("timeseries", cost, respond)
 
 @app.get("/summary", tags=["CovidTimelineCanada"])
 async def get_summary(
+    request: Request,
     geo: str = query_geo,
     loc: list[str] | None = query_loc,
     date: str = Query(
@@ -531,64 +900,75 @@ async def get_summary(
     # initialize response
     response = {"data": {}}
 
-    # get data and process data
-    if geo == "hr":
-        d = pd.DataFrame(columns = ["region", "sub_region_1", "date"])
-        for s in stats_hr:
-            df = data.ctc[s + "_hr"].rename(
-                columns = {"value": s, "value_daily": s + "_daily"})
-            df = df.drop("name", axis = 1)
-            d = pd.merge(d, df, on = ["region", "sub_region_1", "date"], how = "outer")
-    elif geo == "pt":
-        d = pd.DataFrame(columns = ["region", "date"])
-        for s in stats_pt:
-            df = data.ctc[s + "_pt"].rename(
-                columns = {"value": s, "value_daily": s + "_daily"})
-            df = df.drop("name", axis = 1)
-            d = pd.merge(d, df, on = ["region", "date"], how = "outer")
-    elif geo == "can":
-        d = pd.DataFrame(columns = ["region", "date"])
-        for s in stats_can:
-            df = data.ctc[s + "_can"].rename(
-                columns = {"value": s, "value_daily": s + "_daily"})
-            df = df.drop("name", axis = 1)
-            d = pd.merge(d, df, on = ["region", "date"], how = "outer")
-    else:
+    # check geo
+    if geo not in ["hr", "pt", "can"]:
         raise HTTPException(status_code = 400, detail = "Invalid geo")
-    # fill missing dates (before loc filter so not locations are excluded)
-    if fill:
-        d = fill_dates(d, geo)
-    # filter by location
-    if loc:
-        d = loc_filter(d, geo, loc)
-    # filter by date
-    d = date_filter(d, date, after, before, date_invalid_returns_latest = True)
-    # format date column
-    d = format_date_col(d)
-    # convert pt, hr names
-    d = convert_names(d, geo, pt_names = pt_names, hr_names = hr_names)
-    # fill missing values
-    if not fill:
-        d = d.fillna(value = "")
 
-    # sort and summarize data by date
-    if geo == "hr":
-        d = d.sort_values(by = ["date", "region", "sub_region_1"])
-    else:
-        d = d.sort_values(by = ["date", "region"])
-    response["data"] = d.to_dict(orient = "records")  
+    # use the same data snapshot for the whole request
+    snap = request_snapshot(request)
+    version_ctc = snap.version
 
-    # add version to response
-    if version is True:
-        response["version"] = data.version_ctc
-    
-    # convert response to requested format
-    if fmt == "csv":
-        response = fmt_response_csv(
-            pd.DataFrame.fr(response["data"]), "summary")
-    
-    # return response
-    return response
+    # return cached response if available
+    if fmt not in ["csv", "ndjson", "arrow", "parquet"]:
+        key = cache_key(
+            "summary", geo, loc, fill, pt_names, hr_names, date, after, before, version)
+        encoding = request_encoding(request)
+        cached = cached_response(version_ctc, key, encoding)
+        if cached is not None:
+            return cached
+
+    # build filled store if it is not built for today (in a worker thread, since this
+    # reads the whole table)
+    if fill and not filled_current(snap.summary_filled, [geo]):
+        await offload.run("summary", float("inf"), lambda: get_summary_store(snap, geo, True))
+
+    # get precomputed wide table (filled before loc filter so no locations are excluded)
+    st = get_summary_store(snap, geo, fill)
+    # filter by location and date
+    idx = request_filter(request, snap, st, geo, loc, date, after, before, "order_summary", date_invalid_returns_latest = True)
+
+    # build response (in a worker thread unless it is small)
+    def respond():
+        # convert response to requested format
+        if fmt in ["csv", "ndjson", "arrow", "parquet"]:
+            # stream in row batches (for CSV, columns with missing values are written as
+            # objects in all batches; for Arrow and Parquet, columns of integer stats
+            # without missing values are written as integers, others as floats)
+            typed = fmt in ["arrow", "parquet"]
+            nan_cols = []
+            if fmt == "csv" and not fill:
+                nan_cols = [col for col in st["cols"] if col not in st["geo_cols"] and col != "date" and pd.isna(st[col][idx]).any()]
+            types = {}
+            if typed:
+                for col in [x for x in st["cols"] if x not in st["geo_cols"] and x != "date"]:
+                    s, src = (col[:-len("_daily")], "value_daily") if col.endswith("_daily") else (col, "value")
+                    integer = snap.store[s + "_" + geo][src].dtype.kind in "iu"
+                    types[col] = np.int64 if integer and not pd.isna(st[col][idx]).any() else np.float64
+            frames = frame_batches(
+                lambda i: summary_frame(st, i, geo, fill, pt_names, hr_names, nan_cols, typed, types),
+                idx, names_presorted(geo, pt_names, hr_names))
+            if typed:
+                return fmt_response_arrow(frames, fmt, "summary")
+            if fmt == "ndjson":
+                return fmt_response_ndjson(frames)
+            return fmt_response_csv(frames, "summary")
+
+        # process data
+        d = summary_frame(st, idx, geo, fill, pt_names, hr_names)
+        response["data"] = json_records(d)
+
+        # add version to response
+        if version is True:
+            response["version"] = version_ctc
+
+        # serialize response and add to cache
+        body = json_bytes(response)
+        cache.put(version_ctc, key, body)
+        
+        # return response
+        return json_response(version_ctc, key, body, encoding)
+
+    return await offload.run("summary", len(idx) * len(st["cols"]), respond)
 
 @app.get("/datasets", tags=["Archive of Canadian COVID-19 Data"])
 async def get_datasets(
@@ -623,6 +1003,7 @@ async def get_datasets(
 
 @app.get("/archive", tags=["Archive of Canadian COVID-19 Data"])
 async def get_archive(
+    request: Request,
     uuid: str = Query(
         None,
         description = "UUID of dataset from datasets.json"),
@@ -639,7 +1020,12 @@ async def get_archive(
         description = "One of 'all', 'latest', 'first' or a date in YYYY-MM-DD format. If not specified, 'all' is used."),
     after: date | None = query_after,
     before: date | None = query_before,
-    version: bool = query_version
+    version: bool = query_version,
+    fmt: str = Query(
+        "json",
+        description = "Format to return data in. Can be 'json' (default), 'ndjson' (newline-delimited JSON, one record per line), 'arrow' (Apache Arrow IPC stream) or 'parquet' (Apache Parquet). Note that formats other than 'json' will not return any metadata such as the update time.",
+        enum = ["json", "ndjson", "arrow", "parquet"]
+    )
 ):
     
     # read UUIDs
@@ -656,61 +1042,83 @@ async def get_archive(
     # intialize response
     response = {"data": {}}
 
-    # get dataframe
-    df = data.archive["index"]
-    df = df[df["uuid"].isin(uuid)]
+    # use the same file index for the whole request
+    archive, version_archive_index = request_archive(request)
+
+    # find UUIDs in the file index
+    con = archive["con"]
+    counts = archive_index.file_counts(con, uuid)
+    uuid = list(counts)
     
     # return 400 if no valid UUIDs
-    if len(df) == 0:
+    if len(uuid) == 0:
         raise HTTPException(status_code=400, detail=uuid_not_found())
     
-    # date filtering
-    df["file_date"] = pd.to_datetime(df["file_date"])
-    if date:
-        # if date is defined, after and before are ignored
-        if (date == "all"):
-            pass
-        elif (date == "latest"):
-            df = df.groupby("uuid").last()
-        elif (date == "first"):
-            df = df.groupby("uuid").first()
+    # query file index and build response (in a worker thread unless the datasets are small)
+    def respond():
+        # date filtering (in the query; the first/latest file of each dataset is precomputed)
+        ## the final file filter is also applied in the query, unless duplicates are removed first
+        final = keep_only_final_for_date is True and remove_duplicates is not True
+        filters = {}
+        if date:
+            # if date is defined, after and before are ignored
+            if (date == "all"):
+                pass
+            elif (date in ["latest", "first"]):
+                final = False
+            else:
+                filters["date"] = pd.to_datetime(date, format = "%Y-%m-%d").date().isoformat()
         else:
-            if date:
-                df = df[df["file_date"].dt.date == pd.to_datetime(date, format = "%Y-%m-%d").date()]
-    else:
-        if after:
-            df = df[df["file_date"].dt.date >= after]
-        if before:
-            df = df[df["file_date"].dt.date <= before]
-    
-    # return 400 if no results found
-    if len(df) == 0:
-        raise HTTPException(status_code=400, detail=query_no_results())
-    
-    # filter duplicates in the filtered sample
-    # not the same thing as remove file_date_duplicate == 1,
-    # since the first instance of a duplicate dataset may not
-    # be in the filtered sample
-    if (remove_duplicates is True):
-        df = df.drop_duplicates(subset=["file_md5"])
-    
-    # filter files to keep only the last file downloaded on each date
-    if (keep_only_final_for_date is True):
-        df = df[df["file_final_for_date"] == 1]
-    
-    # format output
-    df["file_date"] = df["file_date"].dt.strftime("%Y-%m-%d")
-    response["data"] = df.to_dict(orient="records")
-    
-    # add version to response
-    if version is True:
-        response["version"] = data.version_archive_index
+            if after:
+                filters["after"] = after.isoformat()
+            if before:
+                filters["before"] = before.isoformat()
+        if (date in ["latest", "first"]):
+            df = archive_index.ends(con, uuid, last = date == "latest")
+        else:
+            df = archive_index.files(con, uuid, final = final, **filters)
+        
+        # return 400 if no results found
+        if len(df) == 0 and not (final and archive_index.any_files(con, uuid, **filters)):
+            raise HTTPException(status_code=400, detail=query_no_results())
+        df["file_date"] = pd.to_datetime(df["file_date"])
+        
+        # filter duplicates in the filtered sample
+        # not the same thing as remove file_date_duplicate == 1,
+        # since the first instance of a duplicate dataset may not
+        # be in the filtered sample
+        if (remove_duplicates is True):
+            df = df.drop_duplicates(subset=["file_md5"])
+        
+        # filter files to keep only the last file downloaded on each date
+        if (keep_only_final_for_date is True and not final):
+            df = df[df["file_final_for_date"] == 1]
+        
+        # format output
+        if fmt in ["arrow", "parquet"]:
+            return fmt_response_arrow(
+                (df.iloc[i:i + stream_batch_rows] for i in range(0, max(len(df), 1), stream_batch_rows)), fmt, "archive")
+        df["file_date"] = df["file_date"].dt.strftime("%Y-%m-%d")
+        if fmt == "ndjson":
+            return fmt_response_ndjson(
+                df.iloc[i:i + stream_batch_rows] for i in range(0, max(len(df), 1), stream_batch_rows))
+        response["data"] = json_records(df)
+        
+        # add version to response
+        if version is True:
+            response["version"] = version_archive_index
 
-    # return response
-    return response
+        # return response
+        return Response(json_bytes(response), media_type = "application/json")
+
+    cost = sum(counts.values()) * len(archive_index.columns)
+    if (date in ["latest", "first"]):
+        cost = len(uuid) * len(archive_index.columns)
+    return await offload.run("archive", cost, respond)
 
 @app.get("/version", tags=["Version"])
 async def get_version(
+    request: Request,
     route: str | None = Query(
         None,
         description = "Route to get update time for. If not specified, returns all update times for all routes.",
@@ -724,8 +1132,8 @@ async def get_version(
     response = {}
 
     # get versions
-    response["timeseries"] = data.version_ctc
-    response["summary"] = data.version_ctc
+    response["timeseries"] = request_snapshot(request).version
+    response["summary"] = request_snapshot(request).version
     response["datasets"] = data.version_datasets
     response["archive"] = data.version_archive_index
 
@@ -742,6 +1150,119 @@ async def get_version(
     # return response
     return response
 
+# batch requests
+
+## maximum number of sub-queries in a batch request
+batch_max_queries = 100
+
+## routes available in batch requests
+batch_routes = {"timeseries": get_timeseries, "summary": get_summary, "archive": get_archive}
+
+# function: model of a batch sub-query for a route
+# (fields are the query parameters of the route, with the same types and defaults,
+# except fmt: sub-query results are always JSON)
+def batch_query_model(route):
+    fields = {"route": (Literal[route], ...)}
+    for p in inspect.signature(batch_routes[route]).parameters.values():
+        if p.name not in ["request", "fmt"]:
+            fields[p.name] = (p.annotation, Field(p.default.default, description = p.default.description))
+    return create_model(
+        route.capitalize() + "Query", __config__ = ConfigDict(extra = "forbid"), **fields)
+
+## body of a batch request
+class BatchRequest(BaseModel):
+    queries: list[Annotated[
+        Union[tuple(batch_query_model(route) for route in batch_routes)],
+        Field(discriminator = "route")]] = Field(
+        min_length = 1,
+        max_length = batch_max_queries,
+        description = "Queries to run. Each query has a route ('timeseries', 'summary' or 'archive') and the query parameters of that route (e.g., {\"route\": \"timeseries\", \"stat\": [\"cases\"], \"loc\": [\"ON\"]}).")
+    stream: bool = Field(
+        False,
+        description = "Stream results as newline-delimited JSON as each query is done (in order of completion, with the position of the query as 'index')? Default: false.")
+
+# function: run a sub-query of a batch request (returns status and serialized JSON body)
+# (errors are returned as for GET requests, with the error as the body)
+async def batch_result(request, query):
+    params = query.model_dump(exclude = {"route"})
+    loading = [k for k in route_datasets[query.route] if data.status[k] != "ready"]
+    if loading:
+        return 503, json_bytes({"detail": "Data are loading. Please try again later.", "loading": loading})
+    try:
+        response = await batch_routes[query.route](request, fmt = "json", **params)
+    except HTTPException as e:
+        return e.status_code, json_bytes({"detail": e.detail})
+    except Exception as e:
+        # (other queries of the batch are still answered)
+        print("Batch query failed: " + repr(e))
+        return 500, json_bytes({"detail": "Internal Server Error"})
+    return response.status_code, response.body
+
+# function: serialize a result of a batch request
+# (the body is already serialized, so it is copied as it is)
+def batch_item(status, body, index = None):
+    head = b"{" if index is None else b'{"index":' + str(index).encode() + b","
+    return head + b'"status":' + str(status).encode() + b',"body":' + body + b"}"
+
+# function: result of a batch sub-query with its position
+async def batch_numbered(i, task):
+    return i, await task
+
+@app.post("/batch", tags=["CovidTimelineCanada", "Archive of Canadian COVID-19 Data"])
+async def post_batch(request: Request, batch: BatchRequest):
+
+    # use the same data for all queries (the latest data published by the loader process,
+    # if data are shared); queries share the rows they select from the same store
+    data.sync_data()
+    request_snapshot(request)
+    request_archive(request)
+    request.scope["batch"] = {"selections": {}}
+
+    # run queries (each is built in a worker thread unless it is small)
+    tasks = [asyncio.ensure_future(batch_result(request, q)) for q in batch.queries]
+
+    # stream results in order of completion
+    if batch.stream:
+        async def generate():
+            try:
+                for done in asyncio.as_completed([batch_numbered(i, task) for i, task in enumerate(tasks)]):
+                    i, (status, body) = await done
+                    yield batch_item(status, body, i) + b"\n"
+            finally:
+                for task in tasks:
+                    task.cancel()
+        return StreamingResponse(generate(), media_type = "application/x-ndjson")
+
+    # return results in order of queries
+    results = await asyncio.gather(*tasks)
+    return Response(
+        b'{"results":[' + b",".join(batch_item(status, body) for status, body in results) + b"]}",
+        media_type = "application/json")
+
+# function: status of each dataset
+def data_status():
+    res = {}
+    for k, v in data.status.items():
+        res[k] = {"status": v}
+        if k in data.errors:
+            res[k]["error"] = data.errors[k]
+    return res
+
+@app.get("/health", include_in_schema=False)
+async def get_health():
+    data.sync_data()
+    return JSONResponse(
+        {"status": "ok", "data": data_status(), "offload": offload.info(), "cache": cache.info()},
+        headers = fetch.no_cache_headers)
+
+@app.get("/ready", include_in_schema=False)
+async def get_ready():
+    data.sync_data()
+    ready = all(v == "ready" for v in data.status.values())
+    return JSONResponse(
+        {"status": "ready" if ready else "loading", "data": data_status()},
+        status_code = 200 if ready else 503, headers = fetch.no_cache_headers)
+
 @app.get("/favicon.ico", include_in_schema=False)
 async def get_favicon():
     return FileResponse("favicon.ico")
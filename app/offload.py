@@ -0,0 +1,110 @@
+# run the CPU-bound part of requests off the event loop
+# large responses are built in a bounded pool of worker threads (pandas, NumPy and SQLite
+# release the GIL for much of their work), with a limit on the responses of each route
+# built at the same time; small responses are built inline, since handing them to a
+# thread costs more than building them
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# number of worker threads
+workers = int(os.environ.get("API_WORKER_THREADS", 4))
+
+# responses of each route built in worker threads at the same time
+# (further responses wait in the route's queue)
+limits = {"timeseries": 4, "summary": 4, "archive": 2}
+
+# responses with an estimated cost (values in the response) below this are built inline
+inline_cost = 20000
+
+# pool of worker threads
+executor = ThreadPoolExecutor(max_workers = workers, thread_name_prefix = "offload")
+
+# metrics of each route
+# (queued/running: responses waiting for / being built in a worker thread;
+# max_queued: largest queue; wait_seconds: total time spent in the queue)
+metrics = {route: {
+    "inline": 0, "offloaded": 0, "queued": 0, "running": 0, "max_queued": 0, "wait_seconds": 0.0
+} for route in limits}
+
+# semaphores limiting the responses of each route (event loop and semaphore)
+semaphores = {}
+
+# function: semaphore of a route for the running event loop
+def semaphore(route):
+    loop = asyncio.get_running_loop()
+    s = semaphores.get(route)
+    if s is None or s[0] is not loop:
+        s = semaphores[route] = (loop, asyncio.Semaphore(limits[route]))
+    return s[1]
+
+# body of a streamed response, produced from a synchronous iterator of chunks
+# (if the response is built in a worker thread by run, the following chunks are produced in
+# worker threads as well and the route's slot is held until the stream ends; otherwise
+# they are produced inline)
+class Stream:
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.release = None
+
+    def __aiter__(self):
+        return self.generate()
+
+    async def generate(self):
+        try:
+            while True:
+                if self.release is None:
+                    chunk = next(self.chunks, None)
+                else:
+                    chunk = await asyncio.get_running_loop().run_in_executor(executor, next, self.chunks, None)
+                if chunk is None:
+                    break
+                yield chunk
+        finally:
+            if self.release is not None:
+                self.release()
+                self.release = None
+
+# function: build response with f, in a worker thread if its estimated cost is large
+# (exceptions raised by f are raised to the caller; for responses streamed from a
+# Stream, the route's slot is released when the stream ends)
+async def run(route, cost, f):
+    m = metrics[route]
+    if cost < inline_cost:
+        m["inline"] += 1
+        return f()
+    sem = semaphore(route)
+    m["queued"] += 1
+    m["max_queued"] = max(m["max_queued"], m["queued"])
+    t0 = time.perf_counter()
+    try:
+        await sem.acquire()
+    finally:
+        m["queued"] -= 1
+    m["wait_seconds"] += time.perf_counter() - t0
+    m["offloaded"] += 1
+    m["running"] += 1
+    def release():
+        m["running"] -= 1
+        sem.release()
+    try:
+        response = await asyncio.get_running_loop().run_in_executor(executor, f)
+    except BaseException:
+        release()
+        raise
+    body = getattr(response, "body_iterator", None)
+    if isinstance(body, Stream):
+        body.release = release
+    else:
+        release()
+    return response
+
+# function: metrics of the worker threads and of each route
+def info():
+    return {
+        "workers": workers,
+        "inline_cost": inline_cost,
+        "routes": {route: dict(m, limit = limits[route]) for route, m in metrics.items()}
+    }
@@ -0,0 +1,144 @@
+# serialize responses directly from DataFrame columns
+# JSON output matches the JSONResponse rendering of DataFrame.to_dict(orient = "records")
+import io
+import json
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.ipc
+import pyarrow.parquet
+
+# pre-serialized JSON fragment
+class RawJSON(str):
+    pass
+
+# function: serialize a single value
+def json_value(v):
+    return json.dumps(v, ensure_ascii = False, allow_nan = False)
+
+# function: serialize each value of a column
+# (integral: rows of a float column that hold integers, which are serialized as integers)
+def json_column(x, integral = None):
+    x = np.asarray(x)
+    if x.dtype.kind in "iu":
+        return x.astype(str).tolist()
+    if x.dtype.kind == "f":
+        if not np.isfinite(x).all():
+            raise ValueError("Out of range float values are not JSON compliant")
+        # numpy formats floats with the shortest repr, like float.__repr__
+        if integral is not None and integral.any():
+            out = np.empty(len(x), dtype = object)
+            out[integral] = x[integral].astype(np.int64).astype(str)
+            out[~integral] = x[~integral].astype(str)
+            return out.tolist()
+        return x.astype(str).tolist()
+    if x.dtype.kind == "b":
+        return np.where(x, "true", "false").tolist()
+    if pd.api.types.infer_dtype(x, skipna = False) == "string":
+        # serialize each unique string once
+        codes, uniques = pd.factorize(x)
+        return np.asarray([json_value(v) for v in uniques], dtype = object)[codes].tolist()
+    return [json_value(v) for v in x.tolist()]
+
+# function: serialize each row of a DataFrame as a record
+# (integral: rows that hold integers of float columns, by column)
+def json_rows(d, integral = {}):
+    if len(d) == 0:
+        return []
+    template = "{" + ",".join(
+        json_value(str(col)).replace("%", "%%") + ":%s" for col in d.columns) + "}"
+    cols = [json_column(d[col].to_numpy(), integral.get(col)) for col in d.columns]
+    return [template % row for row in zip(*cols)]
+
+# function: serialize DataFrame as a list of records
+def json_records(d):
+    return RawJSON("[" + ",".join(json_rows(d)) + "]")
+
+# function: serialize DataFrame as newline-delimited records
+def json_lines(d):
+    return "".join([row + "\n" for row in json_rows(d)])
+
+# function: serialize response (dicts, lists, values and pre-serialized fragments)
+def json_dumps(obj):
+    if isinstance(obj, RawJSON):
+        return obj
+    if isinstance(obj, bytes):
+        obj = obj.decode()
+    if isinstance(obj, dict):
+        return "{" + ",".join(json_value(str(k)) + ":" + json_dumps(v) for k, v in obj.items()) + "}"
+    if isinstance(obj, (list, tuple)):
+        return "[" + ",".join(json_dumps(v) for v in obj) + "]"
+    return json_value(obj)
+
+# function: serialize response to bytes
+def json_bytes(obj):
+    return json_dumps(obj).encode("utf-8")
+
+# write-only file object that hands out the bytes written since the last drain
+# (tell() reports the total, which the Parquet writer uses for offsets)
+class ChunkSink(io.RawIOBase):
+
+    def __init__(self):
+        self.chunks = []
+        self.pos = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.chunks.append(bytes(b))
+        self.pos += len(b)
+        return len(b)
+
+    def tell(self):
+        return self.pos
+
+    def drain(self):
+        out = b"".join(self.chunks)
+        self.chunks = []
+        return out
+
+# text columns that are dictionary-encoded in Arrow output: geographic and stat name
+# columns, and archive columns with one value per dataset (other text columns, such as
+# file names and hashes, hold mostly unique values and are written as plain strings)
+dictionary_cols = ["name", "region", "sub_region_1", "uuid", "dir_parent", "dir_file"]
+
+# function: Arrow schema for a DataFrame
+# (dates as date32, integers as int64, strings of dictionary_cols dictionary-encoded)
+def arrow_schema(d):
+    fields = []
+    for col in d.columns:
+        x = d[col]
+        if pd.api.types.is_datetime64_any_dtype(x):
+            t = pa.date32()
+        elif x.dtype.kind in "iu":
+            t = pa.int64()
+        elif x.dtype.kind == "f":
+            t = pa.float64()
+        elif x.dtype.kind == "b":
+            t = pa.bool_()
+        elif col in dictionary_cols:
+            t = pa.dictionary(pa.int32(), pa.string())
+        else:
+            t = pa.string()
+        fields.append(pa.field(str(col), t))
+    return pa.schema(fields)
+
+# function: write frames as an Arrow IPC stream ("arrow") or Parquet file ("parquet")
+# (yields the bytes produced by each frame; the schema is taken from the first frame)
+def arrow_chunks(frames, fmt):
+    sink = ChunkSink()
+    writer = None
+    for d in frames:
+        if writer is None:
+            schema = arrow_schema(d)
+            if fmt == "arrow":
+                writer = pa.ipc.new_stream(sink, schema)
+            else:
+                writer = pa.parquet.ParquetWriter(sink, schema)
+        if len(d) > 0:
+            writer.write_table(pa.Table.from_pandas(d, schema = schema, preserve_index = False))
+        yield sink.drain()
+    if writer is not None:
+        writer.close()
+        yield sink.drain()
@@ -1,9 +1,81 @@
 from fastapi.testclient import TestClient
+import asyncio
+import hashlib
+import httpx
+import json
+import os
+import pytest
+import re
+import sqlite3
+import threading
+import time
+import numpy as np
+import pandas as pd
+import pyarrow as pa
 
-from .main import app
+from .main import app, fill_dates, get_datetime, stats_hr, stats_pt
+from . import main, offload
+from .cache import ResponseCache
+from .data import archive_index, data, fetch, shared
 
 client = TestClient(app)
 
+# seconds to wait for data to load before failing the tests (e.g., without network access)
+ready_timeout = 600
+
+# start the app (data are loaded in the background) and wait until all data are ready
+@pytest.fixture(scope = "module", autouse = True)
+def started():
+    with client:
+        deadline = time.monotonic() + ready_timeout
+        while client.get("/ready").status_code != 200:
+            if time.monotonic() > deadline:
+                pytest.fail("Data not ready after " + str(ready_timeout) + " seconds: " + repr(data.errors))
+            time.sleep(1)
+        yield
+
+# function: frame with text columns as objects and dates in nanoseconds, for comparing
+# frames across pandas versions (pandas 3 builds text columns as strings and reads dates
+# in other resolutions)
+def normalized(d):
+    d = d.copy()
+    for col in d.columns:
+        if pd.api.types.is_datetime64_any_dtype(d[col]):
+            d[col] = d[col].astype("datetime64[ns]")
+        elif pd.api.types.is_string_dtype(d[col]) and not isinstance(d[col].dtype, pd.CategoricalDtype):
+            d[col] = d[col].astype(object)
+    return d
+
+# reference implementation of fill_dates (concat/merge/groupby) for parity test
+def fill_dates_reference(d, geo):
+    if geo == "hr":
+        cols = ["name", "region", "sub_region_1", "date"]
+        stats = list(stats_hr)
+    else:
+        cols = ["name", "region", "date"]
+        stats = list(stats_pt)
+    if "name" not in d.columns:
+        cols.remove("name")
+    df = d[cols[0:len(cols) - 1]].drop_duplicates()
+    df_rows = len(df)
+    dates = pd.date_range(
+        d["date"].min(), get_datetime().date(), freq = "d").to_list()
+    df = pd.concat([df] * len(dates), ignore_index = True)
+    df = df.sort_values(cols[0:len(cols) - 1])
+    df["date"] = dates * df_rows
+    if not pd.api.types.is_datetime64_ns_dtype(df["date"]):
+        df["date"] = pd.to_datetime(df["date"])
+    d = pd.merge(df, d, how = "left", on = cols)
+    d = d.sort_values(by = cols)
+    daily_cols = [x for x in d.columns if re.match("_daily$", x)]
+    d[daily_cols] = d[daily_cols].fillna(0)
+    if "value" in d.columns:
+        d["value"] = d.groupby(cols[0:len(cols) - 1])["value"].transform(lambda x: x.ffill())
+    else:
+        d[stats] = d.groupby(cols[0:len(cols) - 1])[stats].transform(lambda x: x.ffill())
+    d = d.fillna(value = 0)
+    return d
+
 def test_timeseries():
     resp_1 = client.get("/timeseries?stat=cases&geo=hr&loc=3595&date=2022-01-01&hr_names=short&version=true")
     assert resp_1.status_code == 200
@@ -20,4 +92,445 @@ def test_timeseries():
     assert isinstance(resp_1.json()["data"]["cases"][0]["value_daily"], int)
     resp_2 = client.get("/timeseries?loc=UNKNOWN")
     assert resp_2.status_code == 400
-    assert resp_2.json() == {"detail": "Invalid loc"}
\ No newline at end of file
+    assert resp_2.json() == {"detail": "Invalid loc"}
+
+def test_convert_names():
+    # names match the pt and hr name tables
+    pt = data.snapshot.ctc["pt"].set_index("region")
+    hr = data.snapshot.ctc["hr"].set_index("hruid")
+    resp = client.get("/timeseries?stat=cases&geo=hr&loc=3595&date=2022-01-01&pt_names=canonical&hr_names=ccodwg")
+    assert resp.status_code == 200
+    row = resp.json()["data"]["cases"][0]
+    assert row["region"] == pt.loc["ON", "name_canonical"]
+    assert row["sub_region_1"] == hr.loc["3595", "name_ccodwg"]
+    resp = client.get("/summary?geo=pt&loc=ON&date=2022-01-01&pt_names=pruid")
+    assert resp.json()["data"][0]["region"] == pt.loc["ON", "pruid"]
+    # Canada-level names
+    for pt_names, region in [("short", "CAN"), ("canonical", "Canada"), ("ccodwg", "Canada"), ("pruid", 1)]:
+        resp = client.get("/timeseries?stat=cases&geo=can&date=2022-01-01&pt_names=" + pt_names)
+        assert resp.status_code == 200
+        assert resp.json()["data"]["cases"][0]["region"] == region
+    resp = client.get("/timeseries?stat=cases&geo=can&pt_names=UNKNOWN")
+    assert resp.status_code == 400
+    assert resp.json() == {"detail": "Invalid pt_names"}
+
+def test_fill_dates():
+    # timeseries tables
+    for k, geo in [("cases_hr", "hr"), ("deaths_hr", "hr"), ("cases_pt", "pt"), ("vaccine_coverage_dose_1_pt", "pt")]:
+        d = data.expand_table(data.snapshot.ctc[k])
+        pd.testing.assert_frame_equal(
+            normalized(fill_dates(d, geo).reset_index(drop = True)),
+            normalized(fill_dates_reference(d, geo).reset_index(drop = True)))
+    # summary tables
+    for geo, stats in [("hr", stats_hr), ("pt", stats_pt)]:
+        cols = ["region", "sub_region_1", "date"] if geo == "hr" else ["region", "date"]
+        d = pd.DataFrame(columns = cols)
+        for s in stats:
+            df = data.expand_table(data.snapshot.ctc[s + "_" + geo]).rename(
+                columns = {"value": s, "value_daily": s + "_daily"})
+            d = pd.merge(d, df.drop("name", axis = 1), on = cols, how = "outer")
+        pd.testing.assert_frame_equal(
+            normalized(fill_dates(d, geo).reset_index(drop = True)),
+            normalized(fill_dates_reference(d, geo).reset_index(drop = True)))
+
+def test_compact_tables():
+    d = data.snapshot.ctc["cases_hr"]
+    assert isinstance(d["sub_region_1"].dtype, pd.CategoricalDtype)
+    assert d["date"].dtype == np.int32
+    # tables expand to the same frames as a plain read of the file
+    path = os.path.join(data.temp_dir, "CovidTimelineCanada", "data", "hr", "cases_hr.csv")
+    pd.testing.assert_frame_equal(
+        normalized(data.expand_table(d)),
+        normalized(pd.read_csv(path, dtype = {"region": str, "sub_region_1": str}, parse_dates = ["date"])))
+
+def test_conditional_requests():
+    # (uncompressed responses, which have strong ETags)
+    identity = {"Accept-Encoding": "identity"}
+    resp_1 = client.get("/summary?geo=pt&loc=ON", headers = identity)
+    assert resp_1.status_code == 200
+    assert resp_1.headers["cache-control"] == "public, max-age=300"
+    etag = resp_1.headers["etag"]
+    # matching ETag
+    resp_2 = client.get("/summary?geo=pt&loc=ON", headers = {**identity, "If-None-Match": etag})
+    assert resp_2.status_code == 304
+    assert resp_2.content == b""
+    assert resp_2.headers["etag"] == etag
+    # ETag does not depend on parameter order
+    resp_3 = client.get("/summary?loc=ON&geo=pt", headers = {**identity, "If-None-Match": "W/" + etag})
+    assert resp_3.status_code == 304
+    # weak ETags (of compressed responses) are returned in the same form
+    assert resp_3.headers["etag"] == "W/" + etag
+    # different query
+    resp_4 = client.get("/summary?geo=pt&loc=BC", headers = {**identity, "If-None-Match": etag})
+    assert resp_4.status_code == 200
+    assert resp_4.headers["etag"] != etag
+    # If-Modified-Since
+    if "last-modified" in resp_1.headers:
+        resp_5 = client.get("/summary?geo=pt&loc=ON", headers = {**identity, "If-Modified-Since": resp_1.headers["last-modified"]})
+        assert resp_5.status_code == 304
+    # errors are not cached
+    resp_6 = client.get("/timeseries?loc=UNKNOWN")
+    assert resp_6.status_code == 400
+    assert "etag" not in resp_6.headers
+
+def test_compression():
+    resp_1 = client.get("/timeseries?geo=pt&stat=cases", headers = {"Accept-Encoding": "identity"})
+    assert "content-encoding" not in resp_1.headers
+    for enc in ["gzip", "br"]:
+        # first request builds the compressed response, second request is served from the cache
+        for i in range(2):
+            resp_2 = client.get("/timeseries?geo=pt&stat=cases", headers = {"Accept-Encoding": enc})
+            assert resp_2.headers["content-encoding"] == enc
+            assert "Accept-Encoding" in resp_2.headers["vary"]
+            assert resp_2.headers["etag"] == "W/" + resp_1.headers["etag"]
+            assert resp_2.content == resp_1.content
+    # streamed responses
+    resp_3 = client.get("/timeseries?geo=pt&stat=cases&fmt=csv", headers = {"Accept-Encoding": "identity"})
+    resp_4 = client.get("/timeseries?geo=pt&stat=cases&fmt=csv", headers = {"Accept-Encoding": "gzip"})
+    assert resp_4.headers["content-encoding"] == "gzip"
+    assert resp_4.content == resp_3.content
+
+def test_typed_formats():
+    # integer stats are typed as integers, also when filled
+    resp_1 = client.get("/timeseries?geo=pt&stat=cases&stat=deaths&loc=ON&fill=true&fmt=arrow")
+    schema = pa.ipc.open_stream(resp_1.content).schema
+    assert schema.field("value").type == pa.int64()
+    assert schema.field("date").type == pa.date32()
+    # summary columns are floats only for float stats and columns with missing values
+    resp_2 = client.get("/summary?geo=pt&fmt=arrow")
+    schema = pa.ipc.open_stream(resp_2.content).schema
+    assert schema.field("cases").type == pa.int64()
+    assert schema.field("vaccine_coverage_dose_1").type == pa.float64()
+
+def test_multi_stat():
+    # several stats are serialized in one pass and match the data of each stat on its own
+    for query in [
+        "geo=pt&loc=ON&date=5", "geo=pt&loc=QC&fill=true&pt_names=canonical",
+        "geo=hr&loc=ON&date=3&hr_names=short", "geo=can&after=2022-01-01"]:
+        resp_1 = client.get("/timeseries?" + query)
+        assert resp_1.status_code == 200
+        for s in resp_1.json()["data"]:
+            resp_2 = client.get("/timeseries?" + query + "&stat=" + s)
+            assert resp_2.json()["data"][s] == resp_1.json()["data"][s]
+    # stats are returned in the requested order (repeated stats once)
+    resp_3 = client.get("/timeseries?geo=pt&loc=ON&date=5&stat=deaths&stat=cases&stat=deaths")
+    resp_4 = client.get("/timeseries?geo=pt&loc=ON&date=5")
+    assert list(resp_3.json()["data"]) == ["deaths", "cases"]
+    assert resp_3.json()["data"] == {s: resp_4.json()["data"][s] for s in ["deaths", "cases"]}
+
+def test_response_cache():
+    current = ["v1"]
+    cache = ResponseCache(max_bytes = 100, current = lambda: current[0])
+    cache.put("v1", "a", b"body a")
+    assert cache.get("v1", "a") == b"body a"
+    # new data are published: the first request with the new version empties the cache
+    current[0] = "v2"
+    assert cache.get("v2", "a") is None
+    cache.put("v2", "a", b"body a (new)")
+    # requests still holding the previous snapshot neither read nor replace new entries
+    assert cache.get("v1", "a") is None
+    cache.put("v1", "b", b"body b")
+    assert cache.info()["version"] == "v2"
+    assert cache.info()["entries"] == 1
+    assert cache.get("v2", "a") == b"body a (new)"
+    assert cache.get("v2", "b") is None
+    # entries are evicted when the cache is full
+    cache.put("v2", "c", b"x" * 95)
+    assert cache.get("v2", "a") is None
+    assert cache.info()["bytes"] == 95
+    # statistics of the app's cache are reported by /health
+    client.get("/summary?geo=pt&loc=ON")
+    hits = client.get("/health").json()["cache"]["hits"]
+    client.get("/summary?geo=pt&loc=ON")
+    assert client.get("/health").json()["cache"]["hits"] > hits
+
+def test_snapshot_swap():
+    snap = data.snapshot
+    resp_1 = client.get("/summary?geo=pt&loc=ON")
+    assert resp_1.json()["version"] == snap.version
+    # publish a new snapshot with the same tables and a new version
+    data.snapshot = data.Snapshot(
+        snap.ctc, snap.keys_pt, snap.keys_hr, snap.version + " (new)", snap.store, snap.summary, snap.hashes)
+    try:
+        resp_2 = client.get("/summary?geo=pt&loc=ON")
+        assert resp_2.json()["version"] == snap.version + " (new)"
+        assert resp_2.json()["data"] == resp_1.json()["data"]
+        assert resp_2.headers["etag"] != resp_1.headers["etag"]
+        assert client.get("/version").json()["summary"] == snap.version + " (new)"
+    finally:
+        data.snapshot = snap
+
+def test_incremental_reload():
+    snap = data.snapshot
+    try:
+        # tables of unchanged files are reused
+        data.load_data_ctc(data.temp_dir, snap)
+        assert data.snapshot is not snap
+        for k in snap.store:
+            assert data.snapshot.ctc[k] is snap.ctc[k]
+            assert data.snapshot.store[k] is snap.store[k]
+        for geo in ["hr", "pt", "can"]:
+            assert data.snapshot.summary[geo] is snap.summary[geo]
+        # changed files are read again (previous snapshot with a different hash for cases_hr)
+        hashes = dict(snap.hashes)
+        hashes["cases_hr"] = None
+        previous = data.Snapshot(
+            snap.ctc, snap.keys_pt, snap.keys_hr, snap.version, snap.store, snap.summary, hashes)
+        data.load_data_ctc(data.temp_dir, previous)
+        assert data.snapshot.ctc["cases_hr"] is not snap.ctc["cases_hr"]
+        assert data.snapshot.ctc["deaths_hr"] is snap.ctc["deaths_hr"]
+        assert data.snapshot.summary["hr"] is not snap.summary["hr"]
+        assert data.snapshot.summary["pt"] is snap.summary["pt"]
+        for k in snap.summary["hr"]["cols"]:
+            np.testing.assert_array_equal(data.snapshot.summary["hr"][k], snap.summary["hr"][k])
+    finally:
+        data.snapshot = snap
+
+def test_shared_data(tmp_path):
+    snap = data.snapshot
+    stores = {"store_" + k: v for k, v in snap.store.items()}
+    stores.update({"summary_" + k: v for k, v in snap.summary.items()})
+    tables = {"geo_pt": snap.ctc["pt"], "geo_hr": snap.ctc["hr"]}
+    files = {"archive.db": data.archive["path"]}
+    counter = shared.map_counter(str(tmp_path))
+    assert shared.read_counter(counter) == 0
+    generation = shared.write_generation(
+        str(tmp_path), counter, stores, tables, files, {"version_ctc": snap.version})
+    assert shared.read_counter(counter) == generation == 1
+    meta, stores_mapped, tables_mapped, files_mapped = shared.read_generation(str(tmp_path), generation)
+    assert meta["version_ctc"] == snap.version
+    with open(files_mapped["archive.db"], "rb") as f, open(files["archive.db"], "rb") as g:
+        assert f.read() == g.read()
+    for k, s in stores.items():
+        s_mapped = data.index_store(stores_mapped[k], snap.ctc)
+        for col in s["cols"] + ["date_key", "group_start", "group_end", "date_str"] + s["orders"]:
+            if s[col] is None:
+                assert s_mapped[col] is None
+            else:
+                np.testing.assert_array_equal(s_mapped[col], s[col])
+        # arrays are read from the mapped file without copies
+        assert not s_mapped["date"].flags.owndata
+    for k, d in tables.items():
+        pd.testing.assert_frame_equal(tables_mapped[k], d)
+
+def test_snapshot_cache(tmp_path):
+    current = (data.snapshot, data.datasets, data.version_datasets, data.archive, data.version_archive_index)
+    snap = current[0]
+    assert not data.load_cache(str(tmp_path))
+    data.write_cache(str(tmp_path))
+    try:
+        assert data.load_cache(str(tmp_path))
+        assert data.snapshot is not snap
+        assert data.snapshot.version == snap.version
+        assert data.snapshot.hashes == snap.hashes
+        assert data.version_archive_index == current[4]
+        # tables are cached, so unchanged tables can be reused when the sources are checked
+        for k, d in snap.ctc.items():
+            pd.testing.assert_frame_equal(data.snapshot.ctc[k], d)
+        for k, s in snap.store.items():
+            for col in s["cols"] + ["date_key"]:
+                np.testing.assert_array_equal(data.snapshot.store[k][col], s[col])
+        # the file index database is copied out of the cache
+        assert data.archive["path"] != current[3]["path"]
+        assert os.path.dirname(data.archive["path"]) == data.temp_dir
+        uuid = [x[0] for x in current[3]["con"].execute("SELECT DISTINCT uuid FROM archive")]
+        pd.testing.assert_frame_equal(
+            archive_index.files(data.archive["con"], uuid), archive_index.files(current[3]["con"], uuid))
+    finally:
+        data.snapshot, data.datasets, data.version_datasets, data.archive, data.version_archive_index = current
+
+def test_readiness():
+    assert client.get("/ready").json()["status"] == "ready"
+    status = data.status["archive"]
+    data.status["archive"] = "loading"
+    try:
+        # routes using other datasets are still available
+        assert client.get("/datasets").status_code == 200
+        response = client.get("/archive?uuid=x")
+        assert response.status_code == 503
+        assert response.json()["loading"] == ["archive"]
+        assert "Retry-After" in response.headers
+        assert client.get("/version").status_code == 503
+        response = client.get("/ready")
+        assert response.status_code == 503
+        assert response.json()["data"]["archive"]["status"] == "loading"
+        assert client.get("/health").status_code == 200
+    finally:
+        data.status["archive"] = status
+
+def test_offload():
+    query = "/timeseries?geo=pt&stat=cases&loc=ON&fmt=csv"
+    inline = client.get(query)
+    inline_cost = offload.inline_cost
+    offloaded = offload.metrics["timeseries"]["offloaded"]
+    offload.inline_cost = 0
+    try:
+        # responses built in worker threads are the same as responses built inline
+        response = client.get(query)
+        assert response.status_code == 200
+        assert response.content == inline.content
+        assert offload.metrics["timeseries"]["offloaded"] == offloaded + 1
+        # errors raised while building a response are returned as such
+        uuid = data.archive["con"].execute("SELECT uuid FROM archive LIMIT 1").fetchone()[0]
+        assert client.get("/archive?uuid=" + uuid + "&date=1900-01-01").status_code == 400
+        metrics = client.get("/health").json()["offload"]["routes"]["archive"]
+        assert metrics["offloaded"] >= 1 and metrics["queued"] == metrics["running"] == 0
+    finally:
+        offload.inline_cost = inline_cost
+
+def test_offload_stream():
+    query = "/timeseries?geo=pt&stat=cases&fmt=ndjson"
+    inline = client.get(query)
+    # record where each batch of a streamed response is produced
+    batches = []
+    json_lines = main.json_lines
+    def recorded(d):
+        batches.append((threading.current_thread().name, offload.metrics["timeseries"]["running"]))
+        return json_lines(d)
+    inline_cost, stream_batch_rows = offload.inline_cost, main.stream_batch_rows
+    offload.inline_cost = 0
+    main.stream_batch_rows = 1000
+    main.json_lines = recorded
+    try:
+        response = client.get(query)
+        assert response.content == inline.content
+        # all batches are produced in worker threads while the route's slot is held
+        assert len(batches) > 1
+        assert all(name.startswith("offload") and running == 1 for name, running in batches)
+        assert offload.metrics["timeseries"]["running"] == 0
+    finally:
+        offload.inline_cost, main.stream_batch_rows = inline_cost, stream_batch_rows
+        main.json_lines = json_lines
+
+def test_batch():
+    uuid = data.archive["con"].execute("SELECT uuid FROM archive LIMIT 1").fetchone()[0]
+    queries = [
+        "/timeseries?geo=pt&stat=cases&loc=ON&after=2022-01-01",
+        "/timeseries?geo=pt&stat=deaths&loc=ON&after=2022-01-01&version=false",
+        "/summary?geo=hr&loc=ON&pt_names=canonical",
+        "/timeseries?geo=pt&loc=UNKNOWN",
+        "/archive?date=latest&uuid=" + uuid
+    ]
+    batch = [
+        {"route": "timeseries", "geo": "pt", "stat": ["cases"], "loc": ["ON"], "after": "2022-01-01"},
+        {"route": "timeseries", "geo": "pt", "stat": ["deaths"], "loc": ["ON"], "after": "2022-01-01", "version": False},
+        {"route": "summary", "geo": "hr", "loc": ["ON"], "pt_names": "canonical"},
+        {"route": "timeseries", "geo": "pt", "loc": ["UNKNOWN"]},
+        {"route": "archive", "date": "latest", "uuid": uuid}
+    ]
+    # results are the same as separate GET requests, in order of queries
+    resp = client.post("/batch", json = {"queries": batch})
+    assert resp.status_code == 200
+    results = resp.json()["results"]
+    for query, result in zip(queries, results):
+        expected = client.get(query)
+        assert result == {"status": expected.status_code, "body": expected.json()}
+    assert results[3] == {"status": 400, "body": {"detail": "Invalid loc"}}
+    # streamed results carry the position of their query
+    resp = client.post("/batch", json = {"queries": batch, "stream": True})
+    assert resp.status_code == 200
+    streamed = sorted((json.loads(line) for line in resp.text.splitlines()), key = lambda x: x["index"])
+    assert [x["index"] for x in streamed] == list(range(len(batch)))
+    assert [{"status": x["status"], "body": x["body"]} for x in streamed] == results
+    # invalid batches are rejected
+    assert client.post("/batch", json = {"queries": []}).status_code == 422
+    assert client.post("/batch", json = {"queries": [{"route": "datasets"}]}).status_code == 422
+    assert client.post("/batch", json = {"queries": [{"route": "summary", "fmt": "csv"}]}).status_code == 422
+
+# local stub of the upstream data (datasets.json, archive file index and their versions)
+# (requests are recorded as (file name, status); responses carry ETags and are answered
+# with 304 if the client's copy is current)
+def upstream_stub(tmp_path, requested, versions):
+    db = tmp_path / "upstream.db"
+    con = sqlite3.connect(db)
+    pd.DataFrame({
+        "uuid": ["u1", "u1"], "file_name": ["a.csv", "b.csv"],
+        "file_timestamp": ["2022-01-01 12:00", "2022-01-02 12:00"], "file_date": ["2022-01-01", "2022-01-02"],
+        "file_duplicate": [0, 1], "file_md5": ["m1", "m1"], "file_size": [10, 10]
+    }).to_sql("archive", con, index = False)
+    con.close()
+    datasets_json = {"active": {"ab": [{"uuid": "u1", "dir_parent": "ab", "dir_file": "cases"}]}}
+    failures = {"update_time.txt": 1}
+
+    def handler(request):
+        name = request.url.path.split("/")[-1]
+        if failures.get(name, 0) > 0:
+            failures[name] -= 1
+            response = httpx.Response(503)
+        elif name == "update_time.txt":
+            response = httpx.Response(200, content = versions["archive"])
+        elif name == "commits":
+            response = httpx.Response(200, json = [], headers = {"Last-Modified": versions["datasets"]})
+        elif name == "datasets.json":
+            response = httpx.Response(200, json = datasets_json)
+        elif name == "index.db":
+            response = httpx.Response(200, content = db.read_bytes())
+        else:
+            response = httpx.Response(404)
+        if response.status_code == 200:
+            etag = '"' + hashlib.sha1(response.content).hexdigest() + '"'
+            if request.headers.get("if-none-match") == etag:
+                response = httpx.Response(304)
+            response.headers["ETag"] = etag
+        requested.append((name, response.status_code))
+        return response
+
+    return httpx.MockTransport(handler)
+
+def test_refresh(tmp_path):
+    current = (data.datasets, data.version_datasets, data.archive, data.version_archive_index,
+        data.client, data.temp_dir, dict(data.status))
+    requested = []
+    versions = {"datasets": "Mon, 02 Jan 2023 17:00:00 GMT", "archive": b"2023-01-02 12:00 EST"}
+    backoff = fetch.backoff
+    fetch.backoff = 0
+    fetch.last.clear()
+    data.status["ctc"] = "loading"
+    data.temp_dir = str(tmp_path / "temp")
+    data.archive = {}
+    try:
+        data.client = fetch.make_client(upstream_stub(tmp_path, requested, versions))
+        # both versions changed: datasets.json is fetched once for both datasets,
+        # and the failed version check is retried
+        asyncio.run(data.refresh_data())
+        names = [x[0] for x in requested]
+        assert names.count("datasets.json") == 1
+        assert ("update_time.txt", 503) in requested
+        assert list(data.datasets) == ["u1"]
+        assert data.version_datasets == "2023-01-02 12:00 EST"
+        assert data.version_archive_index == versions["archive"]
+        index = archive_index.files(data.archive["con"], ["u1"])
+        assert index["file_url"].tolist() == ["https://data.opencovid.ca/archive/ab/cases/a.csv"] * 2
+        assert index["file_final_for_date"].tolist() == [1, 1]
+        # the database is streamed to disk
+        assert os.path.exists(os.path.join(data.temp_dir, "index.db"))
+        # the archive route queries the file index database
+        response = client.get("/archive?uuid=u1|x&date=latest")
+        assert [x["file_name"] for x in response.json()["data"]] == ["b.csv"]
+        response = client.get("/archive?uuid=u1&remove_duplicates=true")
+        assert [x["file_name"] for x in response.json()["data"]] == ["a.csv"]
+        response = client.get("/archive?uuid=u1&after=2022-01-02")
+        assert [x["file_date"] for x in response.json()["data"]] == ["2022-01-02"]
+        assert client.get("/archive?uuid=u1&date=2022-01-03").status_code == 400
+        assert client.get("/archive?uuid=x").status_code == 400
+        # versions unchanged: only the versions are checked, with conditional requests
+        requested.clear()
+        asyncio.run(data.refresh_data())
+        assert sorted(requested) == [("commits", 304), ("update_time.txt", 304)]
+        assert data.version_datasets == "2023-01-02 12:00 EST"
+        # archive version changed: the index is rebuilt, from the downloaded database if
+        # it has not changed
+        versions["archive"] = b"2023-01-03 12:00 EST"
+        requested.clear()
+        asyncio.run(data.refresh_data())
+        assert ("index.db", 304) in requested and ("datasets.json", 304) in requested
+        assert data.version_archive_index == versions["archive"]
+        assert len(archive_index.files(data.archive["con"], ["u1"])) == 2
+        # the previous database is removed
+        assert len([x for x in os.listdir(data.temp_dir) if x.startswith("archive-")]) == 1
+    finally:
+        fetch.backoff = backoff
+        fetch.last.clear()
+        (data.datasets, data.version_datasets, data.archive, data.version_archive_index,
+            data.client, data.temp_dir, status) = current
+        data.status.update(status)
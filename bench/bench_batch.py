@@ -0,0 +1,55 @@
+# benchmark: dashboard page load (timeseries and summary queries for several stats,
+# locations and date windows) as separate GET requests and as one POST /batch request
+# run from the root directory: python -m bench.bench_batch
+
+import asyncio
+import time
+import httpx
+from app.data import data
+from app.main import app
+
+# dashboard queries (a different date in each round, so responses are not cached)
+def dashboard(day):
+    after = "2022-01-{:02d}".format(day)
+    queries = []
+    for loc in ["ON", "QC", "BC", "AB"]:
+        for stat in ["cases", "deaths", "hospitalizations", "icu"]:
+            queries.append({"route": "timeseries", "stat": [stat], "geo": "pt", "loc": [loc], "after": after})
+        queries.append({"route": "summary", "geo": "pt", "loc": [loc], "after": after})
+    for stat in ["cases", "deaths"]:
+        queries.append({"route": "timeseries", "stat": [stat], "geo": "hr", "loc": ["ON"], "after": after})
+    queries.append({"route": "summary", "geo": "hr", "loc": ["ON"], "date": "1"})
+    return queries
+
+# function: send queries as separate GET requests (at the same time, as a browser would)
+async def run_get(client, queries):
+    await asyncio.gather(*[
+        client.get("/" + q["route"], params = {k: v for k, v in q.items() if k != "route"})
+        for q in queries])
+
+# function: send queries as one batch request
+async def run_batch(client, queries):
+    await client.post("/batch", json = {"queries": queries})
+
+# function: best time of one page load per round
+async def best_time(client, f, days):
+    t = []
+    for day in days:
+        t0 = time.perf_counter()
+        await f(client, dashboard(day))
+        t.append(time.perf_counter() - t0)
+    return min(t)
+
+# run benchmark
+async def main():
+    transport = httpx.ASGITransport(app = app)
+    async with httpx.AsyncClient(transport = transport, base_url = "http://bench") as client:
+        n = len(dashboard(1))
+        t = await best_time(client, run_get, [1, 2, 3, 4, 5])
+        print("{} GET requests: {:.0f} ms".format(n, t * 1000))
+        t = await best_time(client, run_batch, [6, 7, 8, 9, 10])
+        print("1 batch request ({} queries): {:.0f} ms".format(n, t * 1000))
+
+if __name__ == "__main__":
+    data.load_data()
+    asyncio.run(main())
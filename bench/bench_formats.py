@@ -0,0 +1,60 @@
+# benchmark: payload size and encode time of each response format
+# (JSON, CSV, Arrow IPC, Parquet) on full timeseries tables
+# run from the root directory: python -m bench.bench_formats
+
+import csv
+import io
+import numpy as np
+import time
+from app.data import data
+from app.main import get_store, store_frame
+from app.serialize import arrow_chunks, json_records
+
+# function: encode frame as JSON records
+def enc_json(d):
+    return json_records(d).encode("utf-8")
+
+# function: encode frame as CSV (with the options of the CSV responses)
+def enc_csv(d):
+    buf = io.StringIO()
+    d.to_csv(buf, index = False, quoting = csv.QUOTE_NONNUMERIC, float_format = "%.0f")
+    return buf.getvalue().encode("utf-8")
+
+# function: encode frame as Arrow IPC stream
+def enc_arrow(d):
+    return b"".join(arrow_chunks([d], "arrow"))
+
+# function: encode frame as Parquet
+def enc_parquet(d):
+    return b"".join(arrow_chunks([d], "parquet"))
+
+formats = {
+    "json": enc_json,
+    "csv": enc_csv,
+    "arrow": enc_arrow,
+    "parquet": enc_parquet
+}
+
+# function: best of n wall-clock runs
+def best_time(f, n = 3):
+    t = []
+    for i in range(n):
+        t0 = time.perf_counter()
+        f()
+        t.append(time.perf_counter() - t0)
+    return min(t)
+
+# run benchmark
+if __name__ == "__main__":
+    data.load_data()
+    for key in ["cases_pt", "cases_hr"]:
+        geo = key.split("_")[1]
+        s = get_store(data.snapshot, key, geo, False)
+        idx = np.arange(len(s["date"]))
+        print(key + ": " + str(len(idx)) + " rows")
+        for fmt, enc in formats.items():
+            # Arrow and Parquet encode dates as dates, JSON and CSV as strings
+            d = store_frame(s, idx, typed = fmt in ["arrow", "parquet"])
+            size = len(enc(d))
+            t = best_time(lambda: enc(d))
+            print("  {}: {:.1f} KB, {:.1f} ms".format(fmt, size / 1024, t * 1000))
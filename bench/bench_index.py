@@ -0,0 +1,100 @@
+# microbenchmark: region/date index (store_filter) vs. pandas loc_filter/date_filter
+# on the full health-region tables
+# run from the root directory: python -m bench.bench_index
+
+import re
+import timeit
+import pandas as pd
+from fastapi import HTTPException
+from app.data import data
+from app.main import store_filter
+from datetime import date
+
+# queries: (loc, date, after, before)
+queries = [
+    (["ON"], None, date(2022, 1, 1), None),
+    (["3595"], "2022-01-01", None, None),
+    (["BC", "4831"], None, date(2021, 6, 1), date(2021, 12, 31)),
+    (None, "1", None, None),
+    (None, None, date(2022, 1, 1), None)
+]
+
+# function: filter by date (pandas baseline)
+def date_filter(d, date, after, before, date_invalid_returns_latest = False):
+    # HACK: ensure date column is right type
+    if not pd.api.types.is_datetime64_ns_dtype(d["date"]):
+        d["date"] = pd.to_datetime(d["date"])
+    # date: specific date or latest/earlier x days
+    if date:
+        # case: date is date
+        if re.match(r"^\d{4}-\d{2}-\d{2}$", date):
+            d = d[d["date"].dt.date == pd.to_datetime(date).date()]
+        # case: date is positive integer
+        elif date.isdigit():
+            # get grouping columns
+            geo_cols = [x for x in ['region', 'sub_region_1', 'sub_region_2'] if x in d.columns]
+            d = d.groupby(geo_cols).tail(int(date))
+        # case: date is negative integer
+        elif date.startswith("-") and date[1:].isdigit():
+            geo_cols = [x for x in ['region', 'sub_region_1', 'sub_region_2'] if x in d.columns]
+            d = d.groupby(geo_cols).head(-int(date))
+        # case: date is invalid
+        else:
+            if date_invalid_returns_latest:
+                # if invalid value for date, return latest (default behaviour for summary route)
+                geo_cols = [x for x in ['region', 'sub_region_1', 'sub_region_2'] if x in d.columns]
+                d = d.groupby(geo_cols).tail(1)
+            else:
+                # if invalid value for date, ignore parameter (default behaviour for timeseries route)
+                pass
+    if after:
+        d = d[d["date"].dt.date >= after]
+    if before:
+        d = d[d["date"].dt.date <= before]
+    return d
+
+# function: filter by location (pandas baseline)
+def loc_filter(snap, d, geo, loc):
+    for i in range(len(loc)):
+        loc[i] = loc[i].upper()
+    if geo == "hr":
+        k_pt = [x for x in loc if x in snap.keys_pt]
+        k_hr = [x for x in loc if x in snap.keys_hr]
+        if len(k_pt) == 0 and len(k_hr) == 0:
+            raise HTTPException(status_code = 400, detail = "Invalid loc")
+        return d[d["region"].isin(k_pt) | d["sub_region_1"].isin(k_hr)]
+    elif geo == "pt":
+        k_pt = [x for x in loc if x in snap.keys_pt]
+        if len(k_pt) == 0:
+            raise HTTPException(status_code = 400, detail = "Invalid loc")
+        return d[d["region"].isin(k_pt)]
+    elif geo == "can":
+        return d
+    else:
+        raise HTTPException(status_code = 400, detail = "Invalid geo")
+
+# function: pandas path (filters over the whole table)
+def run_pandas(d, loc, date, after, before):
+    if loc:
+        d = loc_filter(data.snapshot, d, "hr", list(loc))
+    return date_filter(d, date, after, before)
+
+# function: indexed path (binary searches over the store)
+def run_index(s, loc, date, after, before):
+    return store_filter(data.snapshot, s, "hr", loc, date, after, before)
+
+# run benchmark
+if __name__ == "__main__":
+    data.load_data()
+    n = 20
+    for stat in ["cases", "deaths"]:
+        d = data.expand_table(data.snapshot.ctc[stat + "_hr"])
+        s = data.snapshot.store[stat + "_hr"]
+        print(stat + "_hr: " + str(len(d)) + " rows")
+        for q in queries:
+            rows_pandas = len(run_pandas(d, *q))
+            rows_index = len(run_index(s, *q))
+            t_pandas = min(timeit.repeat(lambda: run_pandas(d, *q), number = n, repeat = 3)) / n
+            t_index = min(timeit.repeat(lambda: run_index(s, *q), number = n, repeat = 3)) / n
+            print("  loc={} date={} after={} before={}: pandas {:.3f} ms ({} rows), index {:.3f} ms ({} rows), {:.0f}x".format(
+                q[0], q[1], q[2], q[3], t_pandas * 1000, rows_pandas, t_index * 1000, rows_index, t_pandas / t_index))
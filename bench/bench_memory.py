@@ -0,0 +1,28 @@
+# benchmark: memory of the loaded CovidTimelineCanada tables (deep memory usage),
+# read with plain read_csv and with compact types (read_table)
+# run from the root directory: python -m bench.bench_memory
+
+import os
+import pandas as pd
+from app.data import data
+
+# function: deep memory usage of a table in MB
+def table_mb(d):
+    return d.memory_usage(deep = True).sum() / 1024 ** 2
+
+# run benchmark
+if __name__ == "__main__":
+    data.load_data()
+    root = os.path.join(data.temp_dir, "CovidTimelineCanada", "data")
+    total_plain, total_compact = 0, 0
+    for name in data.snapshot.ctc:
+        if name in ["pt", "hr"]:
+            continue
+        geo = name.rsplit("_", 1)[1]
+        path = os.path.join(root, geo, name + ".csv")
+        plain = table_mb(pd.read_csv(path, parse_dates = ["date"]))
+        compact = table_mb(data.read_table(path, geo))
+        total_plain += plain
+        total_compact += compact
+        print("{}: {:.2f} MB -> {:.2f} MB".format(name, plain, compact))
+    print("total: {:.2f} MB -> {:.2f} MB ({:.0%})".format(total_plain, total_compact, total_compact / total_plain))
@@ -0,0 +1,54 @@
+# benchmark: latency of a cheap request (/version) while large responses are being built,
+# with large responses built in worker threads and built inline on the event loop
+# run from the root directory: python -m bench.bench_offload
+
+import asyncio
+import time
+import httpx
+import numpy as np
+from app import offload
+from app.data import data
+from app.main import app
+
+# large JSON queries (a different date in each round, so responses are not cached)
+queries = [
+    "/timeseries?geo=hr&after=2020-01-{:02d}",
+    "/timeseries?geo=pt&after=2020-01-{:02d}",
+    "/summary?geo=hr&after=2020-01-{:02d}"
+]
+
+# function: latencies of /version requests sent while the large queries run
+# (one round of queries per day in days)
+async def version_latency(client, days):
+    latencies = []
+    async def ping():
+        while not done.is_set():
+            t0 = time.perf_counter()
+            await client.get("/version")
+            latencies.append(time.perf_counter() - t0)
+            await asyncio.sleep(0.01)
+    done = asyncio.Event()
+    pinger = asyncio.create_task(ping())
+    t0 = time.perf_counter()
+    for day in days:
+        await asyncio.gather(*[client.get(q.format(day)) for q in queries])
+    total = time.perf_counter() - t0
+    done.set()
+    await pinger
+    return np.array(latencies), total
+
+# function: run benchmark with large responses built in worker threads or inline
+async def run(inline_cost, days):
+    offload.inline_cost = inline_cost
+    transport = httpx.ASGITransport(app = app)
+    async with httpx.AsyncClient(transport = transport, base_url = "http://bench") as client:
+        latencies, total = await version_latency(client, days)
+    print("inline_cost={}: /version p50 {:.0f} ms, max {:.0f} ms ({} requests); large queries {:.1f} s".format(
+        inline_cost, np.median(latencies) * 1000, latencies.max() * 1000, len(latencies), total))
+
+# run benchmark
+if __name__ == "__main__":
+    data.load_data()
+    inline_cost = offload.inline_cost
+    asyncio.run(run(float("inf"), [1, 2, 3]))
+    asyncio.run(run(inline_cost, [4, 5, 6]))
@@ -0,0 +1,34 @@
+# benchmark: startup time from the CovidTimelineCanada files (read CSVs and build stores)
+# compared with startup time from the on-disk snapshot cache
+# run from the root directory: python -m bench.bench_startup
+
+import os
+import tempfile
+import time
+from app.data import data
+
+# function: best of n wall-clock runs
+def best_time(f, n = 3):
+    t = []
+    for i in range(n):
+        t0 = time.perf_counter()
+        f()
+        t.append(time.perf_counter() - t0)
+    return min(t)
+
+# function: size of the latest generation in a snapshot cache directory
+def cache_size(path):
+    latest = os.path.join(path, str(max(int(x) for x in os.listdir(path) if x.isdigit())))
+    return sum(os.path.getsize(os.path.join(latest, f)) for f in os.listdir(latest))
+
+# run benchmark
+if __name__ == "__main__":
+    data.load_data()
+    temp_dir = data.temp_dir
+    with tempfile.TemporaryDirectory() as cache:
+        t = best_time(lambda: data.load_data_ctc(temp_dir))
+        print("read files and build stores: {:.0f} ms".format(t * 1000))
+        t = best_time(lambda: data.write_cache(cache))
+        print("write snapshot cache: {:.0f} ms ({:.1f} MB)".format(t * 1000, cache_size(cache) / 1024 ** 2))
+        t = best_time(lambda: data.load_cache(cache))
+        print("load snapshot cache: {:.0f} ms".format(t * 1000))